@@ -0,0 +1,101 @@
+"""
+Generators for synthetic cohort definitions of a given size, used to measure how
+the engine scales with the shape of the query DAG
+"""
+
+from cohortextractor import codelist, table
+
+from benchmarks import synthetic_data
+
+
+def get_cohort(name):
+    """
+    Return the cohort class given by `name`, which is either "study" for
+    `study_definition.Cohort` or "<shape>:<size>" e.g. "wide:200"
+    """
+    if name == "study":
+        from study_definition import Cohort
+
+        return Cohort
+    shape, _, size = name.partition(":")
+    if shape not in SHAPES or not size.isdigit():
+        raise ValueError(f"Unknown cohort: {name}")
+    return SHAPES[shape](int(size))
+
+
+def make_wide_cohort(width):
+    """
+    Return a cohort class with `width` columns (plus a population), cycling
+    through a mix of the kinds of query real studies make against a different
+    code for every few columns
+    """
+    events = table("clinical_events")
+    first_positive_test_date = (
+        table("sgss_sars_cov_2").filter(positive_result=True).earliest().get("date")
+    )
+    columns = {"population": table("practice_registrations").exists()}
+    for i in range(width):
+        code = synthetic_data.CODES[(i // 4) % len(synthetic_data.CODES)]
+        matching = events.filter(code=codelist([code], system="ctv3"))
+        kind = i % 4
+        if kind == 0:
+            columns[f"count_{i}"] = matching.count()
+        elif kind == 1:
+            columns[f"latest_value_{i}"] = matching.latest().get("numeric_value")
+        elif kind == 2:
+            columns[f"first_date_{i}"] = matching.earliest().get("date")
+        else:
+            columns[f"after_positive_test_{i}"] = matching.filter(
+                "date", greater_than=first_positive_test_date
+            ).exists()
+    return type(f"WideCohort{width}", (), columns)
+
+
+def make_deep_cohort(depth):
+    """
+    Return a cohort class with a chain of `depth` columns, each of which is the
+    date of the first event after the date in the previous column
+    """
+    events = table("clinical_events")
+    date = table("sgss_sars_cov_2").earliest().get("date")
+    columns = {"population": table("practice_registrations").exists()}
+    for i in range(depth):
+        date = events.filter("date", greater_than=date).earliest().get("date")
+        columns[f"date_{i}"] = date
+    return type(f"DeepCohort{depth}", (), columns)
+
+
+def make_shared_cohort(size, width=4):
+    """
+    Return a cohort class with `size` columns arranged in layers of `width`,
+    where each column depends on two columns from the layer before so that
+    every column shares most of its ancestors with every other
+
+    The number of distinct paths through the DAG grows exponentially with the
+    number of layers, which makes this a worst case for anything which walks
+    the DAG without remembering where it has been
+    """
+    events = table("clinical_events")
+    layer = [
+        events.filter(code=codelist([code], system="ctv3")).earliest().get("date")
+        for code in synthetic_data.CODES[:width]
+    ]
+    columns = {"population": table("practice_registrations").exists()}
+    for i in range(size):
+        j = i % width
+        if j == 0 and i > 0:
+            layer = [columns[f"date_{k}"] for k in range(i - width, i)]
+        columns[f"date_{i}"] = (
+            events.filter("date", greater_than=layer[j])
+            .filter("date", less_than=layer[(j + 1) % width])
+            .earliest()
+            .get("date")
+        )
+    return type(f"SharedCohort{size}", (), columns)
+
+
+SHAPES = {
+    "wide": make_wide_cohort,
+    "deep": make_deep_cohort,
+    "shared": make_shared_cohort,
+}
@@ -0,0 +1,92 @@
+"""
+Benchmark of how long it takes to compile cohort definitions of increasing size
+into SQL, without touching a database e.g.
+
+    python -m benchmarks.compiler --shape wide --shape shared --sizes 250 500 1000
+
+For each cohort this times extracting the definition from the cohort class,
+serialising it to and from JSON, constructing the query engine and generating
+the SQL. If compilation scales linearly then the time per column reported for
+each stage should stay roughly constant as the size grows.
+
+Cohorts whose results are selected from more than `max_results_join_size`
+temporary tables have their results built in stages, so the SQL for the largest
+sizes includes the queries which populate each stage. Staging can also be
+forced for smaller sizes e.g.
+
+    python -m benchmarks.compiler --shape wide --sizes 2000 --option results_join_batch_size=100
+"""
+
+import argparse
+import json
+import time
+
+from cohortextractor.backends.tpp import Backend
+from cohortextractor.serialization import (
+    cohort_class_to_definition,
+    cohort_definition_from_dict,
+    cohort_definition_to_dict,
+)
+
+from benchmarks.cohorts import SHAPES
+from benchmarks.end_to_end import parse_option
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--shape", action="append", dest="shapes", choices=sorted(SHAPES)
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200, 400])
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Query engine option, with VALUE parsed as JSON if possible",
+    )
+    args = parser.parse_args(argv)
+    options = dict(parse_option(option) for option in args.option)
+
+    print(f"{'shape':<8} {'size':>6} {'stage':<20} {'seconds':>10} {'us/column':>10}")
+    for shape in args.shapes or sorted(SHAPES):
+        for size in args.sizes:
+            for stage, seconds in time_stages(SHAPES[shape](size), options):
+                print(
+                    f"{shape:<8} {size:>6} {stage:<20} {seconds:>10.3f} "
+                    f"{seconds / size * 1e6:>10.1f}"
+                )
+
+
+def time_stages(cohort_class, options):
+    """
+    Compile `cohort_class` to SQL, yielding the name and wall time of each
+    stage in turn
+    """
+    start = time.perf_counter()
+    definition = cohort_class_to_definition(cohort_class)
+    yield "to_definition", lap(start)
+
+    start = time.perf_counter()
+    serialised = json.dumps(cohort_definition_to_dict(definition))
+    yield "serialise", lap(start)
+
+    start = time.perf_counter()
+    definition = cohort_definition_from_dict(json.loads(serialised))
+    yield "deserialise", lap(start)
+
+    start = time.perf_counter()
+    query_engine = Backend.get_query_engine(definition, **options)
+    yield "construct_engine", lap(start)
+
+    start = time.perf_counter()
+    query_engine.get_sql()
+    yield "get_sql", lap(start)
+
+
+def lap(start):
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark which generates synthetic data for a given number of
+patients, runs cohorts against it with a locally executing query engine and
+reports the wall time, throughput and peak memory of each stage e.g.
+
+    python -m benchmarks.end_to_end --patients 100000 --cohort study --cohort wide:200
+
+By default the data is written to a temporary SQLite database and the cohorts
+are run with the SQLite query engine. Pass `--database-url` to use a different
+database, or to keep the data between runs along with `--skip-generate`.
+
+Temporary tables are populated one at a time on a single connection so that
+each stage can be timed separately, which means options such as `max_workers`
+have no effect here.
+
+Pass `--plan-cache` to run compiled plans from (and add them to) a plan cache,
+in which case the compile stage only covers compiling plans which aren't
+already cached, or `--materialisation-cache` to measure re-running cohorts
+which share temporary tables with earlier runs.
+
+Pass `--columnar-output` to also write the results of each cohort in the
+columnar format of `cohortextractor.columnar`, which is included in the time
+taken to fetch them.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from cohortextractor.backends.tpp import Backend
+from cohortextractor.columnar import ColumnarWriter, get_output_types
+from cohortextractor.materialisation_cache import MaterialisationCache
+from cohortextractor.plan_cache import PlanCache
+from cohortextractor.query_engines import sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+from cohortextractor.tracing import JSONLinesTracer
+
+from benchmarks import synthetic_data
+from benchmarks.cohorts import get_cohort
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--events-per-patient", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--cohort",
+        action="append",
+        dest="cohorts",
+        help=(
+            "'study' for `study_definition.Cohort` or SHAPE:N for a generated "
+            "cohort with N columns where SHAPE is one of wide, deep or shared "
+            "(may be given more than once)"
+        ),
+    )
+    parser.add_argument("--database-url")
+    parser.add_argument("--skip-generate", action="store_true")
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Query engine option, with VALUE parsed as JSON if possible",
+    )
+    parser.add_argument("--json", help="Also write the results as JSON to this path")
+    parser.add_argument(
+        "--trace",
+        help="Write trace events for every query to this path as lines of JSON",
+    )
+    parser.add_argument(
+        "--trace-plans",
+        action="store_true",
+        help="Include query plans in trace events",
+    )
+    parser.add_argument(
+        "--plan-cache",
+        help=(
+            "Run compiled plans cached in this directory, compiling and caching "
+            "them first if necessary"
+        ),
+    )
+    parser.add_argument(
+        "--materialisation-cache",
+        metavar="DATA_VERSION",
+        help=(
+            "Keep temporary tables in the database between runs, reusing them "
+            "for as long as the same DATA_VERSION is given"
+        ),
+    )
+    parser.add_argument(
+        "--columnar-output",
+        metavar="DIRECTORY",
+        help="Write the results of each cohort to this directory in columnar format",
+    )
+    args = parser.parse_args(argv)
+    if args.plan_cache and args.trace:
+        parser.error("--trace can't be used with --plan-cache")
+    if args.plan_cache and args.materialisation_cache:
+        parser.error("--materialisation-cache can't be used with --plan-cache")
+
+    options = dict(parse_option(option) for option in args.option)
+    if args.materialisation_cache:
+        options["materialisation_cache"] = MaterialisationCache(
+            data_version=args.materialisation_cache
+        )
+    cohorts = [(name, get_cohort(name)) for name in args.cohorts or ["study"]]
+
+    with contextlib.ExitStack() as stack:
+        if args.trace:
+            trace_file = stack.enter_context(open(args.trace, "w"))
+            options["tracer"] = JSONLinesTracer(trace_file)
+            options["trace_plans"] = args.trace_plans
+        database_url = args.database_url
+        if database_url is None:
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+            database_url = f"sqlite:///{tmpdir}/benchmark.db"
+        backend = Backend(database_url)
+        timer = StageTimer()
+
+        if not args.skip_generate:
+            with timer.stage("generate_data") as record:
+                with backend.get_sqlalchemy_engine().begin() as connection:
+                    record["rows"] = synthetic_data.generate(
+                        connection,
+                        args.patients,
+                        events_per_patient=args.events_per_patient,
+                        seed=args.seed,
+                    )
+
+        engine_class = get_query_engine_class(backend)
+        plan_cache = PlanCache(args.plan_cache) if args.plan_cache else None
+        output_dir = args.columnar_output
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        for name, cohort_class in cohorts:
+            if plan_cache is not None:
+                run_cached_plan(
+                    name,
+                    cohort_class,
+                    backend,
+                    engine_class,
+                    options,
+                    timer,
+                    plan_cache,
+                    output_dir,
+                )
+            else:
+                run_cohort(
+                    name,
+                    cohort_class,
+                    backend,
+                    engine_class,
+                    options,
+                    timer,
+                    output_dir,
+                )
+
+    timer.print_report()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "stages": timer.records}, f, indent=2)
+
+
+def run_cohort(
+    name, cohort_class, backend, engine_class, options, timer, output_dir=None
+):
+    with timer.stage("compile", name):
+        definition = cohort_class_to_definition(cohort_class)
+        query_engine = engine_class(definition, backend, **options)
+        query_engine.get_sql()
+
+    with backend.get_sqlalchemy_engine().connect() as connection:
+        try:
+            with timer.stage("upload_codelists", name) as record:
+                query_engine.upload_codelists(connection)
+                record["rows"] = sum(
+                    len(set(codelist.codes))
+                    for codelist in query_engine.codelist_tables
+                )
+            with timer.stage("materialise", name):
+                query_engine.materialise(connection)
+            with timer.stage("fetch_results", name) as record:
+                result = query_engine.get_results(connection)
+                fetch_results(
+                    result,
+                    query_engine.batch_size,
+                    record,
+                    definition,
+                    backend,
+                    output_dir,
+                    name,
+                )
+        finally:
+            query_engine.drop_temp_tables(connection)
+
+
+def run_cached_plan(
+    name,
+    cohort_class,
+    backend,
+    engine_class,
+    options,
+    timer,
+    plan_cache,
+    output_dir=None,
+):
+    with timer.stage("compile", name):
+        definition = cohort_class_to_definition(cohort_class)
+        plan = plan_cache.get_plan(definition, backend, engine_class, **options)
+
+    with backend.get_sqlalchemy_engine().connect() as connection:
+        try:
+            with timer.stage("upload_codelists", name):
+                plan.upload_codelists(connection)
+            with timer.stage("materialise", name):
+                plan.populate_temp_tables(connection)
+            with timer.stage("fetch_results", name) as record:
+                result = plan.get_results(connection)
+                fetch_results(
+                    result,
+                    plan.batch_size,
+                    record,
+                    definition,
+                    backend,
+                    output_dir,
+                    name,
+                )
+        finally:
+            plan.drop_temp_tables(connection)
+
+
+def fetch_results(result, batch_size, record, definition, backend, output_dir, name):
+    """
+    Fetch every row from `result`, writing them to a columnar file in
+    `output_dir` if it's given
+    """
+    record["rows"] = 0
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(contextlib.closing(result))
+        writer = None
+        if output_dir:
+            # Cohort names such as "wide:200" aren't valid filenames everywhere
+            filename = name.replace(":", "_") + ".cx"
+            record["output"] = os.path.join(output_dir, filename)
+            file = stack.enter_context(open(record["output"], "wb"))
+            writer = ColumnarWriter(file, get_output_types(definition, backend))
+        while rows := result.fetchmany(batch_size):
+            record["rows"] += len(rows)
+            if writer is not None:
+                writer.write_rows(rows)
+        if writer is not None:
+            writer.close()
+
+
+class StageTimer:
+    def __init__(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, stage, cohort=None):
+        record = {"cohort": cohort, "stage": stage, "rows": None}
+        start = time.perf_counter()
+        yield record
+        record["seconds"] = time.perf_counter() - start
+        if record["rows"] is not None and record["seconds"] > 0:
+            record["rows_per_second"] = record["rows"] / record["seconds"]
+        else:
+            record["rows_per_second"] = None
+        record["peak_rss_mb"] = get_peak_rss_mb()
+        self.records.append(record)
+
+    def print_report(self):
+        print(
+            f"{'cohort':<16} {'stage':<18} {'seconds':>10} {'rows':>12} "
+            f"{'rows/s':>12} {'peak RSS MB':>12}"
+        )
+        for record in self.records:
+            rows = record["rows"]
+            rows_per_second = record["rows_per_second"]
+            print(
+                f"{record['cohort'] or '':<16} {record['stage']:<18} "
+                f"{record['seconds']:>10.3f} "
+                f"{'' if rows is None else rows:>12} "
+                f"{'' if rows_per_second is None else round(rows_per_second):>12} "
+                f"{record['peak_rss_mb']:>12.1f}"
+            )
+
+
+def get_peak_rss_mb():
+    # This is a high-water mark for the whole process (including any database
+    # running in-process) so it can only ever go up from one stage to the next
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS but kilobytes everywhere else
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def get_query_engine_class(backend):
+    if backend.get_sqlalchemy_engine().dialect.name == "sqlite":
+        return sqlite.QueryEngine
+    return backend.query_engine_class
+
+
+def parse_option(option):
+    name, _, value = option.partition("=")
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return name, value
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Generate synthetic data matching the source tables used by `tpp.Backend`
+
+The data is random but has roughly the shape of the real thing: most patients
+have a handful of events and a few have very many, a small number of codes
+account for most events, and only a minority of patients have any test results.
+"""
+
+import numpy as np
+import sqlalchemy
+
+# As in the real database every table is indexed by `patient_id`
+metadata = sqlalchemy.MetaData()
+
+CodedEvents = sqlalchemy.Table(
+    "CodedEvents",
+    metadata,
+    sqlalchemy.Column("patient_id", sqlalchemy.Integer, nullable=False, index=True),
+    sqlalchemy.Column("CTV3Code", sqlalchemy.String(5)),
+    sqlalchemy.Column("ConsultationDate", sqlalchemy.DateTime),
+    sqlalchemy.Column("NumericValue", sqlalchemy.Float),
+)
+
+RegistrationHistory = sqlalchemy.Table(
+    "RegistrationHistory",
+    metadata,
+    sqlalchemy.Column("patient_id", sqlalchemy.Integer, nullable=False, index=True),
+    sqlalchemy.Column("StartDate", sqlalchemy.Date),
+    sqlalchemy.Column("EndDate", sqlalchemy.Date),
+    sqlalchemy.Column("STPCode", sqlalchemy.String(9)),
+)
+
+sgss_positive = sqlalchemy.Table(
+    "sgss_positive",
+    metadata,
+    sqlalchemy.Column("patient_id", sqlalchemy.Integer, nullable=False, index=True),
+    sqlalchemy.Column("date", sqlalchemy.Date),
+)
+
+sgss_negative = sqlalchemy.Table(
+    "sgss_negative",
+    metadata,
+    sqlalchemy.Column("patient_id", sqlalchemy.Integer, nullable=False, index=True),
+    sqlalchemy.Column("date", sqlalchemy.Date),
+)
+
+# The creatinine code used by `study_definition.Cohort` is the most common code,
+# followed by a long tail of others
+CODES = ["XE2q5"] + [f"C{i:04d}" for i in range(1, 1000)]
+CODE_WEIGHTS = 1 / np.arange(1, len(CODES) + 1)
+CODE_WEIGHTS /= CODE_WEIGHTS.sum()
+
+STP_CODES = [f"E540000{i:02d}" for i in range(1, 43)]
+
+# Registrations which haven't ended are given an end date far in the future
+NO_END_DATE = np.datetime64("9999-12-31")
+
+
+def generate(connection, patient_count, events_per_patient=20, seed=0, chunk_size=None):
+    """
+    (Re)create the source tables using `connection` and fill them with data for
+    `patient_count` patients, with patient_ids from 1 to `patient_count`
+
+    Data is generated and inserted `chunk_size` patients at a time so that
+    memory use doesn't grow with the number of patients. Returns the total
+    number of rows inserted.
+    """
+    chunk_size = chunk_size or max(1, 1000000 // events_per_patient)
+    rng = np.random.default_rng(seed)
+    metadata.drop_all(connection)
+    metadata.create_all(connection)
+    row_count = 0
+    for start in range(1, patient_count + 1, chunk_size):
+        patient_ids = np.arange(start, min(start + chunk_size, patient_count + 1))
+        for table, columns in [
+            (CodedEvents, make_coded_events(rng, patient_ids, events_per_patient)),
+            (RegistrationHistory, make_registrations(rng, patient_ids)),
+            (sgss_positive, make_test_results(rng, patient_ids, 0.15, 2)),
+            (sgss_negative, make_test_results(rng, patient_ids, 0.4, 4)),
+        ]:
+            row_count += insert(connection, table, columns)
+    return row_count
+
+
+def insert(connection, table, columns):
+    # Binding plain tuples positionally avoids the per-row overhead of
+    # SQLAlchemy's parameter processing, which dominates for large tables
+    sql = str(table.insert().compile(dialect=connection.dialect))
+    rows = list(zip(*[to_python(column) for column in columns]))
+    if rows:
+        connection.exec_driver_sql(sql, rows)
+    return len(rows)
+
+
+def make_coded_events(rng, patient_ids, events_per_patient):
+    # Event counts are roughly log-normally distributed with the requested mean
+    sigma = 1.2
+    mu = np.log(events_per_patient) - sigma**2 / 2
+    counts = np.floor(rng.lognormal(mu, sigma, len(patient_ids))).astype(np.int64)
+    size = counts.sum()
+    codes = np.array(CODES, dtype=object)[
+        rng.choice(len(CODES), size=size, p=CODE_WEIGHTS)
+    ]
+    dates = random_dates(rng, size, "2010-01-01", "2022-01-01")
+    values = rng.normal(80, 20, size).round(1)
+    values[rng.random(size) < 0.3] = np.nan
+    return [np.repeat(patient_ids, counts), codes, dates, values]
+
+
+def make_registrations(rng, patient_ids):
+    # Every patient has between one and three consecutive registrations, the
+    # last of which is ongoing for most patients
+    counts = rng.integers(1, 4, len(patient_ids))
+    size = counts.sum()
+    durations = rng.integers(30, 3650, size).astype("timedelta64[D]")
+    first_starts = random_dates(rng, len(patient_ids), "2000-01-01", "2015-01-01")
+    group_starts = np.cumsum(counts) - counts
+    # Each registration starts when the previous one ended
+    offsets = np.cumsum(durations) - durations
+    offsets -= np.repeat(offsets[group_starts], counts)
+    starts = np.repeat(first_starts, counts) + offsets
+    ends = starts + durations
+    is_last = np.zeros(size, dtype=bool)
+    is_last[group_starts + counts - 1] = True
+    ends[is_last & (rng.random(size) < 0.9)] = NO_END_DATE
+    stp_codes = np.array(STP_CODES, dtype=object)[rng.integers(0, len(STP_CODES), size)]
+    return [np.repeat(patient_ids, counts), starts, ends, stp_codes]
+
+
+def make_test_results(rng, patient_ids, proportion, max_per_patient):
+    tested = patient_ids[rng.random(len(patient_ids)) < proportion]
+    counts = rng.integers(1, max_per_patient + 1, len(tested))
+    dates = random_dates(rng, counts.sum(), "2020-03-01", "2022-01-01")
+    return [np.repeat(tested, counts), dates]
+
+
+def random_dates(rng, size, start, end):
+    start = np.datetime64(start, "D")
+    days = (np.datetime64(end, "D") - start).astype(np.int64)
+    return start + rng.integers(0, days, size).astype("timedelta64[D]")
+
+
+def to_python(array):
+    if array.dtype.kind == "M":
+        # Gives `datetime.date` objects
+        return array.astype("M8[D]").tolist()
+    elif array.dtype.kind == "f":
+        # NaN is the only value which isn't equal to itself
+        return [None if value != value else value for value in array.tolist()]
+    else:
+        return array.tolist()
@@ -1,8 +1,12 @@
 import sqlalchemy
 
+from cohortextractor.query_lang import OPERATORS
+from cohortextractor.sqlalchemy_utils import get_sqlalchemy_engine
+
 
 class BackendBase:
-    def __init__(self):
+    def __init__(self, database_url=None):
+        self.database_url = database_url
         # Quick and dirty way to make sure each table and column knows what
         # name it was assigned to
         for key, value in vars(self.__class__).items():
@@ -12,14 +16,34 @@ class BackendBase:
                     column_def.name = column_name
 
     @classmethod
-    def get_query_engine(cls, column_definitions):
-        return cls.query_engine_class(column_definitions, backend=cls())
+    def get_query_engine(cls, column_definitions, database_url=None, **options):
+        return cls.query_engine_class(
+            column_definitions, backend=cls(database_url), **options
+        )
+
+    def get_sqlalchemy_engine(self):
+        if self.database_url is None:
+            raise ValueError("No database_url configured for backend")
+        return get_sqlalchemy_engine(self.database_url)
 
-    def get_table_expression(self, table_name):
+    def get_table(self, table_name):
         table = getattr(self, table_name, None)
         if not isinstance(table, Table):
             raise ValueError(f"Unknown table '{table_name}'")
-        table_expression = table.get_query()
+        return table
+
+    def get_column_type(self, table_name, column_name):
+        return self.get_table(table_name).columns[column_name].type
+
+    def get_table_expression(self, table_name, columns=None, predicates=()):
+        """
+        Return a SQLAlchemy object representing the given table
+
+        `columns` and `predicates` are passed to `Table.get_query` to limit
+        what is read from the database
+        """
+        table = self.get_table(table_name)
+        table_expression = table.get_query(columns, predicates)
         table_expression = table_expression.alias(table_name)
         return table_expression
 
@@ -28,11 +52,26 @@ class Table:
 
     query_function = None
 
-    def __init__(self, *, columns, source=None):
+    def __init__(self, *, columns, source=None, branches=None, watermarks=None):
+        """
+        `columns` maps the name of each column to a Column
+
+        `source` is the name of the database table the rows come from, if it's
+        not the same as the table's own name
+
+        `branches` is a list of Branches, for tables whose rows are combined
+        from several database tables
+
+        `watermarks` is a list of the columns which record when each row was
+        added or last changed, which incremental runs use to find the patients
+        whose rows have changed
+        """
         if "patient_id" not in columns:
             columns["patient_id"] = Column("int")
         self.source = source
         self.columns = columns
+        self.branches = branches
+        self.watermarks = watermarks
 
     def get_column_names(self):
         return self.columns.keys()
@@ -42,7 +81,20 @@ class Table:
         self.query_function = query_function
         return query_function
 
-    def get_query(self):
+    def get_query(self, columns=None, predicates=()):
+        """
+        Return a query which selects the rows of the table
+
+        If `columns` is given then only those columns (plus `patient_id`) are
+        selected. `predicates` is a list of `(column, operator, value)` tuples
+        (e.g. `("code", "__eq__", "XE2q5")`) which every row the caller uses
+        will satisfy, and which are applied as early as possible so that rows
+        which can't satisfy them are never read. Rows which don't satisfy them
+        may still be returned, so the caller must apply them too.
+
+        Custom query functions are opaque, so always select every row and
+        column.
+        """
         if self.query_function:
             query = sqlalchemy.text(self.query_function())
             query = query.columns(
@@ -52,18 +104,98 @@ class Table:
                 ]
             )
             return query
+
+        column_names = [
+            name
+            for name in self.get_column_names()
+            if columns is None or name == "patient_id" or name in columns
+        ]
+        if not self.branches:
+            return self.default_query_function(column_names, predicates)
+
+        queries = []
+        for branch in self.branches:
+            query = self.get_branch_query(branch, column_names, predicates)
+            if query is not None:
+                queries.append(query)
+        if not queries:
+            # No rows can satisfy the predicates but we still need a query with
+            # the right columns
+            query = self.get_branch_query(self.branches[0], column_names, ())
+            return query.where(sqlalchemy.false())
+        elif len(queries) == 1:
+            return queries[0]
         else:
-            return self.default_query_function()
+            return sqlalchemy.union_all(*queries)
+
+    def default_query_function(self, column_names, predicates):
+        return self.get_branch_query(
+            Branch(self.source or self.name), column_names, predicates
+        )
+
+    def get_branch_query(self, branch, column_names, predicates):
+        """
+        Return a query selecting the given columns from a single database
+        table, or None if the branch's constant values mean that none of its
+        rows can satisfy the predicates
+        """
+        conditions = []
+        for column_name, operator_name, value in predicates:
+            if column_name in branch.constants:
+                constant = branch.constants[column_name]
+                result = evaluate_predicate(constant, operator_name, value)
+                if result is False:
+                    return None
+                elif result is True:
+                    continue
+                column = sqlalchemy.literal(constant)
+            else:
+                column = self.get_source_column(column_name)
+            conditions.append(getattr(column, operator_name)(value))
 
-    def default_query_function(self):
-        table_name = self.source or self.name
         columns = []
-        for name, column in self.columns.items():
-            source = column.source or column.name
-            columns.append(sqlalchemy.literal_column(source).label(name))
-        query = sqlalchemy.select(columns).select_from(sqlalchemy.table(table_name))
+        for name in column_names:
+            if name in branch.constants:
+                column = sqlalchemy.literal(branch.constants[name])
+            else:
+                column = self.get_source_column(name)
+            columns.append(column.label(name))
+        query = sqlalchemy.select(columns).select_from(sqlalchemy.table(branch.source))
+        if conditions:
+            query = query.where(sqlalchemy.and_(*conditions))
         return query
 
+    def get_source_column(self, column_name):
+        column = self.columns[column_name]
+        return sqlalchemy.literal_column(column.source or column.name)
+
+
+class Branch:
+    """
+    One of the database tables from which a Table's rows are selected, where
+    `constants` gives fixed values for any of the table's columns which don't
+    come from the database table e.g.
+
+        Branch("sgss_positive", constants={"positive_result": True})
+    """
+
+    def __init__(self, source, constants=None):
+        self.source = source
+        self.constants = constants or {}
+
+
+def evaluate_predicate(constant, operator_name, value):
+    """
+    Return whether a constant satisfies a predicate, or None if we can't tell
+    without asking the database (because SQL compares NULLs and mixed types
+    differently to Python)
+    """
+    if constant is None or value is None or operator_name not in OPERATORS:
+        return None
+    if type(constant) is not type(value):
+        return None
+    return OPERATORS[operator_name](constant, value)
+
 
 class Column:
     def __init__(self, column_type, source=None, system=None):
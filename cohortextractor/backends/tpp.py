@@ -1,12 +1,16 @@
 from cohortextractor.query_engines import mssql
 
-from .base import BackendBase, Table, Column
+from .base import BackendBase, Branch, Table, Column
 
 
 class Backend(BackendBase):
 
     query_engine_class = mssql.QueryEngine
 
+    # There are no columns recording when rows were inserted so we use the
+    # dates the rows refer to as watermarks instead. This means incremental runs
+    # won't pick up rows which are backdated to before the previous run.
+
     clinical_events = Table(
         source="CodedEvents",
         columns=dict(
@@ -14,23 +18,21 @@ class Backend(BackendBase):
             date=Column("datetime", source="ConsultationDate"),
             numeric_value=Column("float", source="NumericValue"),
         ),
+        watermarks=["date"],
     )
 
     sgss_sars_cov_2 = Table(
         columns=dict(
             date=Column("date"),
             positive_result=Column("boolean"),
-        )
+        ),
+        branches=[
+            Branch("sgss_positive", constants=dict(positive_result=True)),
+            Branch("sgss_negative", constants=dict(positive_result=False)),
+        ],
+        watermarks=["date"],
     )
 
-    @sgss_sars_cov_2.query
-    def sgss_sars_cov_2_query():
-        return """
-        SELECT patient_id, date, True AS positive_result FROM sgss_positive
-        UNION ALL
-        SELECT patient_id, date, False AS positive_result FROM sgss_negative
-        """
-
     practice_registrations = Table(
         source="RegistrationHistory",
         columns=dict(
@@ -38,4 +40,7 @@ class Backend(BackendBase):
             date_end=Column("date", source="EndDate"),
             stp_code=Column("categorical", source="STPCode"),
         ),
+        # A registration which ends has its end date changed from a date far
+        # in the future to a date within the watermark window
+        watermarks=["date_start", "date_end"],
     )
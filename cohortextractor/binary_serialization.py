@@ -0,0 +1,357 @@
+"""
+A compact binary encoding of cohort definitions, as an alternative to the
+dictionaries produced by `cohort_definition_to_dict` for shipping definitions
+between services and archiving large numbers of them
+
+An encoded definition consists of:
+
+    the bytes in `MAGIC`
+
+    a record for each node in topological order (so that references always
+    point to nodes which have already been decoded) consisting of the code for
+    the node's class (see `CLASS_CODES`) followed by each of its attribute
+    values, in the order given by the class's `_fields`
+
+    a zero byte, marking the end of the nodes
+
+    the number of outputs, followed by the name and value of each
+
+Class codes and counts are encoded as unsigned LEB128 varints. Every other
+value is a tag byte followed by its contents. Nodes are referenced by their
+position in the sequence of nodes and strings are interned, so that only the
+first occurrence of each string is encoded in full and later occurrences are
+encoded as its position in the table of strings seen so far.
+
+Decoding streams through the data, constructing each node as soon as its record
+has been read.
+"""
+
+import io
+import struct
+from collections import namedtuple
+
+from cohortextractor.query_lang import (
+    BaseTable,
+    Codelist,
+    Column,
+    FilteredTable,
+    QueryNode,
+    Row,
+    ValueFromAggregate,
+    ValueFromRow,
+    walk_query_dag,
+)
+from cohortextractor.serialization import (
+    CLASS_MAP,
+    CLASS_MAP_INVERSE,
+    get_node_id_order,
+)
+
+MAGIC = b"CXDEF\x01"
+
+# These codes are part of the format so must never be changed or reused
+CLASS_CODES = {
+    BaseTable: 1,
+    FilteredTable: 2,
+    Column: 3,
+    Row: 4,
+    ValueFromRow: 5,
+    ValueFromAggregate: 6,
+    Codelist: 7,
+}
+CLASSES_BY_CODE = {code: cls for cls, code in CLASS_CODES.items()}
+
+END_OF_NODES = 0
+
+# Tags for each type of value
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT = 3
+NEGATIVE_INT = 4
+FLOAT = 5
+NEW_STRING = 6
+STRING = 7
+LIST = 8
+NODE = 9
+
+FLOAT_FORMAT = struct.Struct("<d")
+
+# A reference to a node by its position in the sequence of nodes
+NodeRef = namedtuple("NodeRef", "index")
+
+
+def cohort_definition_to_bytes(cohort_definition):
+    file = io.BytesIO()
+    write_cohort_definition(cohort_definition, file)
+    return file.getvalue()
+
+
+def cohort_definition_from_bytes(data):
+    return read_cohort_definition(io.BytesIO(data))
+
+
+def write_cohort_definition(cohort_definition, file):
+    node_indexes = {}
+
+    def to_ref(value):
+        if isinstance(value, QueryNode):
+            return NodeRef(node_indexes[value])
+        return value
+
+    def records():
+        for node in walk_query_dag(cohort_definition.values()):
+            node_indexes[node] = len(node_indexes)
+            values = [to_ref(getattr(node, name)) for name in node._fields]
+            yield type(node), values
+
+    outputs = ((column, to_ref(value)) for column, value in cohort_definition.items())
+    write_records(file, records(), outputs)
+
+
+def read_cohort_definition(file):
+    nodes = []
+
+    def from_ref(value):
+        if isinstance(value, NodeRef):
+            return nodes[value.index]
+        return value
+
+    reader = Reader(file)
+    for node_class, values in reader.read_records():
+        nodes.append(node_class.from_values([from_ref(value) for value in values]))
+    return {column: from_ref(value) for column, value in reader.read_outputs()}
+
+
+def cohort_dict_to_bytes(data):
+    """
+    Encode a definition in the format produced by `cohort_definition_to_dict`
+    without constructing any nodes
+
+    Node IDs aren't preserved as such: nodes are numbered in topological order
+    so the IDs are restored exactly for any dictionary produced by
+    `cohort_definition_to_dict`.
+    """
+    node_defs = data["nodes"]
+    node_ids = get_node_id_order(node_defs)
+    node_indexes = {node_id: i for i, node_id in enumerate(node_ids)}
+
+    def to_ref(value):
+        if isinstance(value, dict):
+            return NodeRef(node_indexes[value["node"]])
+        return value
+
+    def records():
+        for node_id in node_ids:
+            node_def = node_defs[node_id]
+            node_class = CLASS_MAP_INVERSE[(node_def["type"], node_def["from"])]
+            attrs = node_def["attrs"]
+            if set(attrs) != set(node_class._fields):
+                raise ValueError(f"Unexpected attributes for node {node_id}")
+            yield node_class, [to_ref(attrs[name]) for name in node_class._fields]
+
+    outputs = ((column, to_ref(value)) for column, value in data["outputs"].items())
+    file = io.BytesIO()
+    write_records(file, records(), outputs)
+    return file.getvalue()
+
+
+def cohort_dict_from_bytes(data):
+    """
+    Decode a definition into the format produced by `cohort_definition_to_dict`
+    without constructing any nodes
+    """
+
+    def from_ref(value):
+        if isinstance(value, NodeRef):
+            return {"node": f"#{value.index + 1}"}
+        elif isinstance(value, list):
+            return [from_ref(item) for item in value]
+        return value
+
+    reader = Reader(io.BytesIO(data))
+    node_defs = {}
+    for node_class, values in reader.read_records():
+        type_, operation = CLASS_MAP[node_class]
+        node_defs[f"#{len(node_defs) + 1}"] = {
+            "type": type_,
+            "from": operation,
+            "attrs": {
+                name: from_ref(value) for name, value in zip(node_class._fields, values)
+            },
+        }
+    outputs = {column: from_ref(value) for column, value in reader.read_outputs()}
+    return {"nodes": node_defs, "outputs": outputs}
+
+
+def write_records(file, records, outputs):
+    writer = Writer(file)
+    writer.write_bytes(MAGIC)
+    for node_class, values in records:
+        writer.write_varint(CLASS_CODES[node_class])
+        for value in values:
+            writer.write_value(value)
+    writer.write_varint(END_OF_NODES)
+    outputs = list(outputs)
+    writer.write_varint(len(outputs))
+    for column, value in outputs:
+        writer.write_value(column)
+        writer.write_value(value)
+    writer.flush()
+
+
+class Writer:
+    # Number of bytes to accumulate before writing them to the file
+    buffer_size = 65536
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = bytearray()
+        self.strings = {}
+
+    def write_bytes(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(bytes(self.buffer))
+        self.buffer.clear()
+
+    def write_varint(self, value):
+        data = bytearray()
+        while value >= 0x80:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+        self.write_bytes(data)
+
+    def write_tag(self, tag):
+        self.write_bytes(bytes([tag]))
+
+    def write_value(self, value):
+        # Note that the order matters here as `bool` is a subclass of `int`
+        # and `NodeRef` a subclass of `tuple`
+        if value is None:
+            self.write_tag(NONE)
+        elif value is False:
+            self.write_tag(FALSE)
+        elif value is True:
+            self.write_tag(TRUE)
+        elif isinstance(value, NodeRef):
+            self.write_tag(NODE)
+            self.write_varint(value.index)
+        elif isinstance(value, int):
+            if value >= 0:
+                self.write_tag(INT)
+                self.write_varint(value)
+            else:
+                self.write_tag(NEGATIVE_INT)
+                self.write_varint(-value - 1)
+        elif isinstance(value, float):
+            self.write_tag(FLOAT)
+            self.write_bytes(FLOAT_FORMAT.pack(value))
+        elif isinstance(value, str):
+            self.write_string(value)
+        elif isinstance(value, (list, tuple)):
+            self.write_tag(LIST)
+            self.write_varint(len(value))
+            for item in value:
+                self.write_value(item)
+        else:
+            raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+    def write_string(self, value):
+        index = self.strings.get(value)
+        if index is not None:
+            self.write_tag(STRING)
+            self.write_varint(index)
+        else:
+            self.strings[value] = len(self.strings)
+            encoded = value.encode("utf-8")
+            self.write_tag(NEW_STRING)
+            self.write_varint(len(encoded))
+            self.write_bytes(encoded)
+
+
+class Reader:
+    # Number of bytes to read from the file at a time
+    chunk_size = 65536
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = b""
+        self.position = 0
+        self.strings = []
+        if self.read_bytes(len(MAGIC)) != MAGIC:
+            raise ValueError("Data is not an encoded cohort definition")
+
+    def read_records(self):
+        """
+        Yield the class and attribute values of each node in turn
+        """
+        while True:
+            code = self.read_varint()
+            if code == END_OF_NODES:
+                return
+            try:
+                node_class = CLASSES_BY_CODE[code]
+            except KeyError:
+                raise ValueError(f"Unknown node class code: {code}")
+            yield node_class, [self.read_value() for _ in node_class._fields]
+
+    def read_outputs(self):
+        for _ in range(self.read_varint()):
+            column = self.read_value()
+            yield column, self.read_value()
+
+    def read_bytes(self, length):
+        while len(self.buffer) - self.position < length:
+            chunk = self.file.read(max(self.chunk_size, length))
+            if not chunk:
+                raise ValueError("Unexpected end of encoded cohort definition")
+            self.buffer = self.buffer[self.position :] + chunk
+            self.position = 0
+        data = self.buffer[self.position : self.position + length]
+        self.position += length
+        return data
+
+    def read_byte(self):
+        return self.read_bytes(1)[0]
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_value(self):
+        tag = self.read_byte()
+        if tag == NONE:
+            return None
+        elif tag == FALSE:
+            return False
+        elif tag == TRUE:
+            return True
+        elif tag == INT:
+            return self.read_varint()
+        elif tag == NEGATIVE_INT:
+            return -self.read_varint() - 1
+        elif tag == FLOAT:
+            return FLOAT_FORMAT.unpack(self.read_bytes(FLOAT_FORMAT.size))[0]
+        elif tag == NEW_STRING:
+            value = self.read_bytes(self.read_varint()).decode("utf-8")
+            self.strings.append(value)
+            return value
+        elif tag == STRING:
+            return self.strings[self.read_varint()]
+        elif tag == LIST:
+            return [self.read_value() for _ in range(self.read_varint())]
+        elif tag == NODE:
+            return NodeRef(self.read_varint())
+        else:
+            raise ValueError(f"Unknown value tag: {tag}")
@@ -0,0 +1,329 @@
+"""
+A typed, columnar file format for cohort results which can be memory-mapped,
+so that downstream analysis can load even very large extracts without parsing
+them e.g.
+
+    write_results(query_engine, "cohort.cx")
+    reader = ColumnarReader("cohort.cx")
+    dates, valid = reader.read_column("date_of_birth")
+
+Each column is stored as a compact array whose type is taken from the backend
+column it is derived from:
+
+    int         int64
+    float       float64
+    date        int32 days since 1970-01-01
+    datetime    int64 microseconds since 1970-01-01
+    boolean     bit-packed, eight values per byte
+    categorical int32 indexes into a dictionary of the column's distinct values
+    code        as categorical
+
+along with a bit-packed validity bitmap which is zero wherever the value is
+NULL. Rows are written in chunks, so the full result set never needs to be
+held in memory, and a file consists of:
+
+    the bytes in `MAGIC`
+
+    for each chunk, the validity bitmap and values of each column in turn,
+    each padded to a multiple of eight bytes so that every array is aligned
+
+    a JSON footer giving the type of each column, the dictionary of each
+    dictionary-encoded column and the number of rows and array offsets of
+    each chunk
+
+    the length of the footer as an unsigned 64-bit integer, followed by the
+    bytes in `MAGIC` again
+
+Reading a column from a single chunk file involves no copying at all, other
+than unpacking booleans and converting dates to `datetime64[D]`.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from cohortextractor.query_lang import (
+    BaseTable,
+    FilteredTable,
+    Row,
+    ValueFromAggregate,
+    ValueFromRow,
+)
+
+MAGIC = b"CXCOL\x01"
+
+FOOTER_LENGTH_FORMAT = struct.Struct("<Q")
+
+ALIGNMENT = 8
+
+# The NumPy dtype in which each type of column is stored
+STORAGE_DTYPES = {
+    "int": np.dtype("<i8"),
+    "float": np.dtype("<f8"),
+    "date": np.dtype("<i4"),
+    "datetime": np.dtype("<i8"),
+    "boolean": np.dtype("u1"),
+    "categorical": np.dtype("<i4"),
+    "code": np.dtype("<i4"),
+}
+
+DICTIONARY_ENCODED_TYPES = {"categorical", "code"}
+
+
+def write_results(query_engine, path, chunk_size=None):
+    """
+    Run the query engine's cohort and write the results to `path`, returning
+    the number of rows written
+    """
+    column_types = get_output_types(
+        query_engine.column_definitions, query_engine.backend
+    )
+    with open(path, "wb") as file:
+        writer = ColumnarWriter(file, column_types, chunk_size)
+        for rows in query_engine.iter_result_batches(writer.chunk_size):
+            writer.write_rows(rows)
+        writer.close()
+    return writer.row_count
+
+
+def get_output_types(column_definitions, backend):
+    """
+    Return a dictionary mapping the name of each column in the results
+    (including `patient_id`) to its type
+    """
+    column_types = {"patient_id": "int"}
+    for column_name, output_node in column_definitions.items():
+        if column_name != "population":
+            column_types[column_name] = get_value_type(output_node, backend)
+    return column_types
+
+
+def get_value_type(value, backend):
+    if isinstance(value, ValueFromRow):
+        return get_source_column_type(value.source, value.column, backend)
+    elif isinstance(value, ValueFromAggregate):
+        if value.function == "exists":
+            return "boolean"
+        elif value.function == "count":
+            return "int"
+        elif value.function == "avg":
+            return "float"
+        elif value.function in ("min", "max", "sum"):
+            return get_source_column_type(value.source, value.column, backend)
+        else:
+            raise ValueError(f"Unsupported aggregate function: {value.function}")
+    else:
+        raise TypeError(
+            f"Cannot write values of type {type(value).__name__} as an output column"
+        )
+
+
+def get_source_column_type(source, column, backend):
+    while isinstance(source, (Row, FilteredTable)):
+        source = source.source
+    assert type(source) is BaseTable
+    return backend.get_column_type(source.name, column)
+
+
+class ColumnarWriter:
+    # Number of rows to accumulate before writing them out as a chunk
+    chunk_size = 1_000_000
+
+    def __init__(self, file, column_types, chunk_size=None):
+        """
+        `column_types` maps the name of each column, in the order in which
+        they appear in each row, to its type
+        """
+        for column_name, column_type in column_types.items():
+            if column_type not in STORAGE_DTYPES:
+                raise ValueError(
+                    f"Unsupported type '{column_type}' for column '{column_name}'"
+                )
+        self.file = file
+        self.column_types = dict(column_types)
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.dictionaries = {
+            column_name: {}
+            for column_name, column_type in self.column_types.items()
+            if column_type in DICTIONARY_ENCODED_TYPES
+        }
+        self.chunks = []
+        self.pending_rows = []
+        self.row_count = 0
+        self.position = 0
+        self.write_bytes(MAGIC)
+        self.write_padding()
+
+    def write_rows(self, rows):
+        self.pending_rows.extend(rows)
+        while len(self.pending_rows) >= self.chunk_size:
+            self.write_chunk(self.pending_rows[: self.chunk_size])
+            del self.pending_rows[: self.chunk_size]
+
+    def close(self):
+        """
+        Write any remaining rows and the footer, which must happen before the
+        file can be read
+        """
+        if self.pending_rows:
+            self.write_chunk(self.pending_rows)
+            self.pending_rows = []
+        footer = {
+            "columns": self.column_types,
+            "dictionaries": {
+                column_name: list(dictionary)
+                for column_name, dictionary in self.dictionaries.items()
+            },
+            "chunks": self.chunks,
+        }
+        footer_bytes = json.dumps(footer).encode("utf-8")
+        self.write_bytes(footer_bytes)
+        self.write_bytes(FOOTER_LENGTH_FORMAT.pack(len(footer_bytes)))
+        self.write_bytes(MAGIC)
+
+    def write_chunk(self, rows):
+        columns = {}
+        for index, (column_name, column_type) in enumerate(self.column_types.items()):
+            # This is much faster than transposing the rows with `zip(*rows)`
+            values = [row[index] for row in rows]
+            valid = np.array([value is not None for value in values], dtype=bool)
+            data = self.encode(column_name, column_type, values, valid)
+            columns[column_name] = {
+                "valid": self.write_array(np.packbits(valid, bitorder="little")),
+                "values": self.write_array(data),
+            }
+        self.chunks.append({"rows": len(rows), "columns": columns})
+        self.row_count += len(rows)
+
+    def encode(self, column_name, column_type, values, valid):
+        dtype = STORAGE_DTYPES[column_type]
+        if column_type in ("int", "float"):
+            # Any value will do for NULLs as they're marked invalid anyway
+            values = [0 if value is None else value for value in values]
+            return np.array(values, dtype=dtype)
+        elif column_type in ("date", "datetime"):
+            # NumPy parses both ISO format strings (as returned by some
+            # drivers) and `date`/`datetime` objects
+            values = [value if value is not None else "NaT" for value in values]
+            unit = "D" if column_type == "date" else "us"
+            dates = np.array(values, dtype="datetime64[us]").astype(
+                f"datetime64[{unit}]"
+            )
+            return np.where(valid, dates.view(np.int64), 0).astype(dtype)
+        elif column_type == "boolean":
+            bits = np.array([bool(value) for value in values], dtype=bool)
+            return np.packbits(bits, bitorder="little")
+        else:
+            # New values are added to the dictionary as they're first seen, so
+            # that it never needs to be rewritten
+            dictionary = self.dictionaries[column_name]
+            for value in dict.fromkeys(values):
+                if value is not None and value not in dictionary:
+                    dictionary[value] = len(dictionary)
+            lookup = {**dictionary, None: 0}
+            return np.fromiter(map(lookup.__getitem__, values), dtype, len(values))
+
+    def write_array(self, array):
+        """
+        Write the array's bytes, padded to the alignment, returning its offset
+        and length in bytes
+        """
+        offset = self.position
+        data = array.tobytes()
+        self.write_bytes(data)
+        self.write_padding()
+        return [offset, len(data)]
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def write_padding(self):
+        self.write_bytes(b"\x00" * (-self.position % ALIGNMENT))
+
+
+class ColumnarReader:
+    def __init__(self, path):
+        """
+        Memory-map the file at `path`, so that only those parts of it which
+        are actually read are loaded from disk
+        """
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        trailer_size = FOOTER_LENGTH_FORMAT.size + len(MAGIC)
+        if (
+            len(self.data) < len(MAGIC) + trailer_size
+            or self.data[: len(MAGIC)].tobytes() != MAGIC
+            or self.data[-len(MAGIC) :].tobytes() != MAGIC
+        ):
+            raise ValueError(f"{path} is not a complete columnar results file")
+        footer_end = len(self.data) - trailer_size
+        (footer_length,) = FOOTER_LENGTH_FORMAT.unpack(
+            self.data[footer_end : footer_end + FOOTER_LENGTH_FORMAT.size].tobytes()
+        )
+        footer = json.loads(
+            self.data[footer_end - footer_length : footer_end].tobytes()
+        )
+        self.column_types = footer["columns"]
+        self.dictionaries = footer["dictionaries"]
+        self.chunks = footer["chunks"]
+        self.row_count = sum(chunk["rows"] for chunk in self.chunks)
+
+    def get_dictionary(self, column_name):
+        """
+        Return the list of distinct values of a dictionary-encoded column, which
+        the values returned by `read_column` are indexes into
+        """
+        return self.dictionaries[column_name]
+
+    def read_column(self, column_name):
+        """
+        Return a pair of arrays giving the values of the column and whether
+        each of them is valid (i.e. not NULL)
+        """
+        if len(self.chunks) == 1:
+            return self.read_chunk_column(0, column_name)
+        elif not self.chunks:
+            column_type = self.column_types[column_name]
+            values = np.zeros(0, dtype=STORAGE_DTYPES[column_type])
+            return decode(values, column_type), np.zeros(0, dtype=bool)
+        values, valid = zip(
+            *[
+                self.read_chunk_column(index, column_name)
+                for index in range(len(self.chunks))
+            ]
+        )
+        return np.concatenate(values), np.concatenate(valid)
+
+    def read_chunk_column(self, index, column_name):
+        """
+        As `read_column`, but for just the given chunk
+        """
+        chunk = self.chunks[index]
+        column_type = self.column_types[column_name]
+        location = chunk["columns"][column_name]
+        valid = self.read_bits(location["valid"], chunk["rows"])
+        if column_type == "boolean":
+            values = self.read_bits(location["values"], chunk["rows"])
+        else:
+            offset, length = location["values"]
+            values = self.data[offset : offset + length].view(
+                STORAGE_DTYPES[column_type]
+            )
+        return decode(values, column_type), valid
+
+    def read_bits(self, location, row_count):
+        offset, length = location
+        bits = np.unpackbits(self.data[offset : offset + length], bitorder="little")
+        return bits[:row_count].view(bool)
+
+
+def decode(values, column_type):
+    if column_type == "date":
+        return values.astype("datetime64[D]")
+    elif column_type == "datetime":
+        return values.view("datetime64[us]")
+    elif column_type == "boolean":
+        return values.astype(bool)
+    return values
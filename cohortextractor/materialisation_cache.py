@@ -0,0 +1,180 @@
+"""
+A cache of materialised temporary tables which persists between runs, so that
+re-running a cohort after changing a few of its columns only rebuilds the
+tables which those changes affect e.g.
+
+    cache = MaterialisationCache(data_version=get_last_refresh_date)
+    query_engine = Backend.get_query_engine(
+        column_definitions, database_url, materialisation_cache=cache
+    )
+
+When a query engine is given a cache, each of its temporary tables is instead
+created as a permanent table named after a fingerprint of everything which
+determines its contents: the part of the query DAG it is derived from, the
+backend's table definitions and any options which restrict its patients. A
+registry table in the database records the tables which have been fully
+populated along with the data version they were populated from, and the least
+recently used tables are dropped once the total number of rows in the cache
+exceeds `max_rows`.
+
+The cache must not be shared between runs which execute at the same time,
+whether in the same process or not. Nothing coordinates them, so one run
+could drop a table which another has just looked up (because it belongs to a
+stale data version, or to make room), or one which another is part way
+through populating. Concurrent runs should each be given their own
+`table_prefix` and `registry_table`.
+"""
+
+import time
+
+import sqlalchemy
+
+from cohortextractor.query_lang import QueryNode, walk_query_dag
+from cohortextractor.serialization import get_fingerprint
+
+# Increment this whenever a change to the query engines could change the
+# contents of the table they generate for a given fingerprint, so that tables
+# populated by earlier versions are never used
+FINGERPRINT_VERSION = 1
+
+
+class MaterialisationCache:
+    def __init__(
+        self,
+        data_version=None,
+        max_rows=100_000_000,
+        table_prefix="cx_cache",
+        registry_table="cx_cache_registry",
+    ):
+        """
+        `data_version` identifies the current state of the data in the database
+        (e.g. the time it was last refreshed) and is either a string or a
+        callable which is passed a connection and returns one. Tables populated
+        from a different version of the data are dropped rather than reused.
+
+        `max_rows` is the maximum total number of rows, across every table in
+        the cache, to keep between runs
+
+        `table_prefix` and `registry_table` give the names of the tables the
+        cache creates, which must not clash with any other tables
+        """
+        self.data_version = data_version
+        self.max_rows = max_rows
+        self.table_prefix = table_prefix
+        self.registry = sqlalchemy.Table(
+            registry_table,
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column("table_name", sqlalchemy.String(128), primary_key=True),
+            sqlalchemy.Column("data_version", sqlalchemy.String(256)),
+            sqlalchemy.Column("row_count", sqlalchemy.BigInteger),
+            sqlalchemy.Column("last_used", sqlalchemy.Float),
+        )
+
+    def get_table_name(self, fingerprint):
+        return f"{self.table_prefix}_{fingerprint[:32]}"
+
+    def prepare(self, connection):
+        """
+        Create the registry if it doesn't already exist and drop any tables
+        populated from a different version of the data, returning the current
+        data version
+        """
+        self.registry.create(connection, checkfirst=True)
+        data_version = self.get_data_version(connection)
+        stale = connection.execute(
+            sqlalchemy.select([self.registry.c.table_name]).where(
+                self.registry.c.data_version != data_version
+            )
+        ).fetchall()
+        for (table_name,) in stale:
+            self.remove(connection, table_name)
+        return data_version
+
+    def get_data_version(self, connection):
+        data_version = self.data_version
+        if callable(data_version):
+            data_version = data_version(connection)
+        return str(data_version)
+
+    def lookup(self, connection, table_name, data_version):
+        """
+        Return True if the given table has been fully populated from the given
+        version of the data, marking it as recently used
+        """
+        registry = self.registry
+        entry = connection.execute(
+            sqlalchemy.select([registry.c.data_version]).where(
+                registry.c.table_name == table_name
+            )
+        ).fetchone()
+        if entry is None or entry.data_version != data_version:
+            return False
+        connection.execute(
+            registry.update()
+            .where(registry.c.table_name == table_name)
+            .values(last_used=time.time())
+        )
+        return True
+
+    def store(self, connection, table_name, data_version, row_count):
+        """
+        Record that the given table has been fully populated
+        """
+        registry = self.registry
+        connection.execute(registry.delete().where(registry.c.table_name == table_name))
+        connection.execute(
+            registry.insert().values(
+                table_name=table_name,
+                data_version=data_version,
+                row_count=row_count,
+                last_used=time.time(),
+            )
+        )
+
+    def evict(self, connection, keep=()):
+        """
+        Drop the least recently used tables, other than those in `keep`, until
+        the total number of rows in the cache is no more than `max_rows`
+        """
+        registry = self.registry
+        entries = connection.execute(
+            sqlalchemy.select([registry.c.table_name, registry.c.row_count]).order_by(
+                registry.c.last_used
+            )
+        ).fetchall()
+        total_rows = sum(entry.row_count for entry in entries)
+        for entry in entries:
+            if total_rows <= self.max_rows:
+                break
+            if entry.table_name not in keep:
+                self.remove(connection, entry.table_name)
+                total_rows -= entry.row_count
+
+    def remove(self, connection, table_name):
+        registry = self.registry
+        connection.execute(registry.delete().where(registry.c.table_name == table_name))
+        self.drop_table(connection, table_name)
+
+    @staticmethod
+    def drop_table(connection, table_name):
+        table = sqlalchemy.Table(table_name, sqlalchemy.MetaData())
+        table.drop(connection, checkfirst=True)
+
+
+def get_node_fingerprints(nodes):
+    """
+    Return a dictionary mapping every node in the DAG leading to `nodes` to a
+    fingerprint of the node and everything it is derived from
+
+    Each fingerprint is a hash of the node's own attributes with references to
+    other nodes replaced by their fingerprints, so they can all be calculated
+    in a single pass over the DAG.
+    """
+    fingerprints = {}
+    for node in walk_query_dag(nodes):
+        attrs = {
+            key: fingerprints[value] if isinstance(value, QueryNode) else value
+            for key, value in node.to_dict().items()
+        }
+        fingerprints[node] = get_fingerprint([type(node).__name__, attrs])
+    return fingerprints
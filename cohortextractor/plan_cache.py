@@ -0,0 +1,257 @@
+"""
+An on-disk cache of compiled query plans, so that running the same cohort
+against the same backend again doesn't have to rebuild and recompile every
+SQLAlchemy query expression e.g.
+
+    plan_cache = PlanCache("~/.cache/cohortextractor/plans")
+    plan = plan_cache.get_plan(cohort_definition, backend)
+    for rows in plan.iter_result_batches(backend):
+        ...
+
+Plans are keyed by a hash of the serialized cohort definition along with
+everything else which affects the SQL generated for it: the query engine and
+its SQL dialect, the backend's table definitions and any query engine options.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+
+from cohortextractor.backends.base import Table
+from cohortextractor.serialization import cohort_definition_to_dict, get_fingerprint
+
+# Increment this whenever a change to the query engines could change the SQL
+# they generate for a given cohort definition, so that plans compiled by earlier
+# versions are never used
+PLAN_FORMAT_VERSION = 2
+
+# Query engine options which affect how queries are executed rather than the
+# SQL which is generated for them. Cached plans are always executed in order
+# on a single connection, so these are ignored when compiling them.
+EXECUTION_OPTIONS = {"batch_size", "max_workers", "tracer", "trace_plans"}
+
+
+class CompiledPlan:
+    """
+    The SQL statements needed to run a cohort, in the order in which they must
+    be executed, which can be run without a query engine
+    """
+
+    # Number of rows fetched from the database at a time when streaming results
+    batch_size = 10000
+
+    def __init__(self, codelist_statements, temp_tables, results_sql, drop_statements):
+        """
+        `codelist_statements` is a list of statements which create and populate
+        the codelist tables
+
+        `temp_tables` is a list of dictionaries, one for each temporary table in
+        the order in which they must be populated, giving the table's name, the
+        statements which populate it and the names of the other temporary
+        tables which must be populated first
+
+        `results_sql` is the query which selects the results
+
+        `drop_statements` is a list of statements which drop every table
+        """
+        self.codelist_statements = codelist_statements
+        self.temp_tables = temp_tables
+        self.results_sql = results_sql
+        self.drop_statements = drop_statements
+
+    def to_dict(self):
+        return {
+            "codelist_statements": self.codelist_statements,
+            "temp_tables": self.temp_tables,
+            "results_sql": self.results_sql,
+            "drop_statements": self.drop_statements,
+        }
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        return cls(**dictionary)
+
+    def upload_codelists(self, connection):
+        for statement in self.codelist_statements:
+            connection.exec_driver_sql(statement)
+
+    def populate_temp_tables(self, connection):
+        for temp_table in self.temp_tables:
+            for statement in temp_table["statements"]:
+                connection.exec_driver_sql(statement)
+
+    def get_results(self, connection):
+        connection = connection.execution_options(stream_results=True)
+        return connection.exec_driver_sql(self.results_sql)
+
+    def execute(self, connection):
+        """
+        Materialise all temporary tables using `connection` and then run the
+        results query, returning a SQLAlchemy result object from which rows
+        can be fetched
+
+        As with `QueryEngine.execute` the caller is responsible for keeping the
+        connection open until all rows have been fetched
+        """
+        self.upload_codelists(connection)
+        self.populate_temp_tables(connection)
+        return self.get_results(connection)
+
+    def iter_result_batches(self, backend, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        with backend.get_sqlalchemy_engine().connect() as connection:
+            try:
+                with contextlib.closing(self.execute(connection)) as result:
+                    while rows := result.fetchmany(batch_size):
+                        yield rows
+            finally:
+                self.drop_temp_tables(connection)
+
+    def iter_results(self, backend, batch_size=None):
+        for rows in self.iter_result_batches(backend, batch_size):
+            yield from rows
+
+    def drop_temp_tables(self, connection):
+        for statement in self.drop_statements:
+            connection.exec_driver_sql(statement)
+
+
+class PlanCache:
+    """
+    A directory of compiled plans, one file per plan, which is kept to at most
+    `max_size` bytes by deleting the least recently used plans
+    """
+
+    def __init__(self, directory, max_size=100 * 1024**2):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_plan(self, cohort_definition, backend, query_engine_class=None, **options):
+        """
+        Return the compiled plan for running `cohort_definition` against
+        `backend`, compiling it (and adding it to the cache) if it isn't
+        already cached
+
+        `query_engine_class` defaults to the backend's query engine and
+        `options` are passed to the query engine as usual
+        """
+        if query_engine_class is None:
+            query_engine_class = backend.query_engine_class
+        compile_options = {
+            name: value
+            for name, value in options.items()
+            if name not in EXECUTION_OPTIONS
+        }
+        key = get_plan_key(
+            cohort_definition, backend, query_engine_class, compile_options
+        )
+        plan = self.load(key)
+        if plan is None:
+            query_engine = query_engine_class(
+                cohort_definition, backend, **compile_options
+            )
+            plan = query_engine.get_plan()
+            self.store(key, plan)
+        return plan
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path) as f:
+                plan = CompiledPlan.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError):
+            # A plan which can't be read is no use to anyone
+            self.remove(path)
+            return None
+        # Mark the plan as recently used so that it's evicted last
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return plan
+
+    def store(self, key, plan):
+        # Write to a temporary file first so that other processes sharing the
+        # cache never see a partially written plan
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(plan.to_dict(), f)
+            os.replace(tmp_path, self.get_path(key))
+        except BaseException:
+            self.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used plans until the cache is no larger than
+        `max_size`
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
+
+    def get_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def remove(path):
+        # Another process sharing the cache may have got there first
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def get_plan_key(cohort_definition, backend, query_engine_class, options):
+    """
+    Return a hash identifying the plan compiled for the given arguments
+    """
+    key = {
+        "format": PLAN_FORMAT_VERSION,
+        "cohort": cohort_definition_to_dict(cohort_definition),
+        "query_engine": get_qualified_name(query_engine_class),
+        "dialect": query_engine_class.sqlalchemy_dialect.dialect.name,
+        "backend": get_qualified_name(type(backend)),
+        "tables": describe_backend_tables(backend),
+        "options": options,
+    }
+    return get_fingerprint(key)
+
+
+def describe_backend_tables(backend):
+    """
+    Return a description of every table the backend defines, so that changes
+    to the backend change the key of every plan compiled against it
+    """
+    tables = {}
+    for name, table in vars(type(backend)).items():
+        if isinstance(table, Table):
+            tables[name] = {
+                "source": table.source,
+                "query": table.query_function() if table.query_function else None,
+                "watermarks": table.watermarks,
+                "branches": [
+                    [branch.source, branch.constants] for branch in table.branches or []
+                ],
+                "columns": {
+                    column_name: [column.type, column.source, column.system]
+                    for column_name, column in table.columns.items()
+                },
+            }
+    return tables
+
+
+def get_qualified_name(cls):
+    return f"{cls.__module__}.{cls.__qualname__}"
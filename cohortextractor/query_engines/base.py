@@ -0,0 +1,18 @@
+class QueryEngineBase:
+    def __init__(self, column_definitions, backend, **options):
+        """
+        `column_definitions` is a dictionary mapping output column names to
+        Values, which are leaf nodes in DAG of QueryNodes
+
+        `backend` is a Backend instance
+
+        `options` override any of the configuration attributes defined on the
+        class e.g. `batch_size`
+        """
+        self.column_definitions = column_definitions
+        self.backend = backend
+        self.options = options
+        for name, value in options.items():
+            if not hasattr(self, name) or callable(getattr(self, name)):
+                raise TypeError(f"Unknown query engine option '{name}'")
+            setattr(self, name, value)
@@ -0,0 +1,349 @@
+"""
+A query engine which evaluates the query DAG directly over in-memory columnar
+data held in NumPy arrays, without needing a database
+
+To use it, set `query_engine_class` on a backend to this class and pass the
+data as the `tables` option, which maps each table name to a dictionary of
+column names to arrays e.g.
+
+    engine = MyBackend.get_query_engine(
+        column_definitions,
+        tables={
+            "clinical_events": {
+                "patient_id": np.array([1, 1, 2]),
+                "code": np.array(["XE2q5", "ABC", "XE2q5"], dtype=object),
+                "date": np.array(["2020-01-01", ...], dtype="datetime64[D]"),
+                ...
+            },
+            ...
+        },
+    )
+
+NULLs are represented by NaN (for floats), NaT (for dates) or None (for object
+arrays) and are handled with the same semantics as in SQL.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from cohortextractor.query_lang import (
+    BaseTable,
+    Codelist,
+    Column,
+    FilteredTable,
+    OPERATORS,
+    Row,
+    Value,
+    ValueFromAggregate,
+    ValueFromRow,
+    walk_query_dag,
+)
+from cohortextractor.query_engines.base import QueryEngineBase
+
+# A set of rows from a table, represented as the full set of columns for that
+# table plus an array of indices of the selected rows
+Rows = namedtuple("Rows", "columns indices")
+
+# A single value per patient, with `patient_ids` in ascending order and `valid`
+# being False wherever the value is NULL
+PatientValues = namedtuple("PatientValues", "patient_ids values valid")
+
+
+class QueryEngine(QueryEngineBase):
+
+    # Dictionary mapping table names to dictionaries mapping column names to
+    # arrays of values
+    tables = None
+
+    # Number of rows yielded at a time by `iter_result_batches`
+    batch_size = 10000
+
+    def __init__(self, column_definitions, backend, **options):
+        super().__init__(column_definitions, backend, **options)
+        # Results of evaluating each node, so that nodes shared between
+        # different parts of the DAG are only evaluated once
+        self.cache = {}
+
+    def get_results(self):
+        """
+        Return a dictionary mapping each output column name to a masked array
+        of values, with one entry per patient in the population
+        """
+        # Evaluate every node in topological order first, so that evaluating
+        # a node always finds its parents already in the cache rather than
+        # recursing down long chains of nodes
+        for node in walk_query_dag(self.column_definitions.values()):
+            if not isinstance(node, (Codelist, Column)):
+                self.evaluate(node)
+
+        column_definitions = self.column_definitions.copy()
+        population = self.evaluate(column_definitions.pop("population"))
+        is_included = population.valid & (population.values == True)  # noqa: E712
+        patient_ids = population.patient_ids[is_included]
+
+        results = {"patient_id": patient_ids}
+        for column_name, output_node in column_definitions.items():
+            values, valid = lookup(self.evaluate(output_node), patient_ids)
+            results[column_name] = np.ma.MaskedArray(values, mask=~valid)
+        return results
+
+    def iter_result_batches(self, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        results = self.get_results()
+        for start in range(0, len(results["patient_id"]), batch_size):
+            columns = [
+                column[start : start + batch_size].tolist()
+                for column in results.values()
+            ]
+            yield list(zip(*columns))
+
+    def iter_results(self, batch_size=None):
+        for rows in self.iter_result_batches(batch_size):
+            yield from rows
+
+    def evaluate(self, node):
+        try:
+            return self.cache[node]
+        except KeyError:
+            pass
+        if type(node) is BaseTable:
+            result = self.evaluate_base_table(node)
+        elif isinstance(node, FilteredTable):
+            result = self.evaluate_filter(node)
+        elif isinstance(node, Row):
+            result = self.evaluate_row(node)
+        elif isinstance(node, ValueFromRow):
+            result = self.evaluate_value_from_row(node)
+        elif isinstance(node, ValueFromAggregate):
+            result = self.evaluate_aggregate(node)
+        else:
+            raise TypeError(f"Unhandled type: {node}")
+        self.cache[node] = result
+        return result
+
+    def evaluate_base_table(self, node):
+        # Check the table is one the backend knows about
+        self.backend.get_table(node.name)
+        if self.tables is None or node.name not in self.tables:
+            raise ValueError(f"No data supplied for table '{node.name}'")
+        columns = {
+            name: np.asarray(array) for name, array in self.tables[node.name].items()
+        }
+        # We keep the rows of every table in patient_id order (filtering
+        # preserves the order) so that each patient's rows are contiguous and
+        # can be grouped without any further sorting
+        patient_ids = columns["patient_id"]
+        if np.all(patient_ids[1:] >= patient_ids[:-1]):
+            indices = np.arange(len(patient_ids))
+        else:
+            indices = np.argsort(patient_ids, kind="stable")
+        return Rows(columns, indices)
+
+    def evaluate_filter(self, node):
+        rows = self.evaluate(node.source)
+        column = rows.columns[node.column][rows.indices]
+        if isinstance(node.value, Codelist):
+            if node.operator != "__eq__":
+                raise ValueError("Codelists can only be used in equality filters")
+            null = is_null(column)
+            codes = np.array(node.value.codes, dtype=object)
+            mask = np.isin(sortable(column, null), codes) & ~null
+        elif isinstance(node.value, Value):
+            patient_ids = rows.columns["patient_id"][rows.indices]
+            values, valid = lookup(self.evaluate(node.value), patient_ids)
+            mask = compare(column, node.operator, values) & valid
+        elif node.value is None:
+            # Follow SQLAlchemy in treating `== None` as `IS NULL`
+            if node.operator != "__eq__":
+                raise ValueError("NULL can only be used in equality filters")
+            mask = is_null(column)
+        else:
+            value = np.asarray(node.value)
+            if column.dtype.kind in "mM":
+                value = value.astype(column.dtype)
+            mask = compare(column, node.operator, value)
+        return Rows(rows.columns, rows.indices[mask])
+
+    def evaluate_row(self, node):
+        """
+        Return the rows selected by the given Row node, one per patient, in
+        patient_id order
+        """
+        rows = self.evaluate(node.source)
+        patient_ids = rows.columns["patient_id"][rows.indices]
+        starts = get_group_starts(patient_ids)
+        if len(node.sort_columns) == 1:
+            column = rows.columns[node.sort_columns[0]][rows.indices]
+            key = get_numeric_sort_key(column)
+            if key is not None:
+                # Note that `descending` selects the row with the largest value,
+                # just as ordering descending and taking the first row does in
+                # SQL
+                function = np.maximum if node.descending else np.minimum
+                selected = get_first_in_group(key, function, starts)
+                return Rows(rows.columns, rows.indices[selected])
+
+        # Otherwise sort by patient and then by each sort column in turn, with
+        # NULLs sorting first as they do in SQL Server. `lexsort` treats its
+        # last key as the primary one.
+        keys = []
+        for column_name in reversed(node.sort_columns):
+            column = rows.columns[column_name][rows.indices]
+            null = is_null(column)
+            keys.extend([sortable(column, null), ~null])
+        keys.append(patient_ids)
+        order = np.lexsort(keys)
+        if node.descending:
+            selected = get_group_ends(starts, len(order))
+        else:
+            selected = starts
+        return Rows(rows.columns, rows.indices[order[selected]])
+
+    def evaluate_value_from_row(self, node):
+        rows = self.evaluate(node.source)
+        values = rows.columns[node.column][rows.indices]
+        return PatientValues(
+            rows.columns["patient_id"][rows.indices], values, ~is_null(values)
+        )
+
+    def evaluate_aggregate(self, node):
+        rows = self.evaluate(node.source)
+        patient_ids = rows.columns["patient_id"][rows.indices]
+        starts = get_group_starts(patient_ids)
+        unique_ids = patient_ids[starts]
+        if node.function == "exists":
+            values = np.ones(len(unique_ids), dtype=bool)
+            return PatientValues(unique_ids, values, values)
+
+        column = rows.columns[node.column][rows.indices]
+        if len(column) == 0:
+            return PatientValues(unique_ids, column, np.zeros(0, dtype=bool))
+        null = is_null(column)
+        counts = np.add.reduceat((~null).astype(np.int64), starts)
+        valid = counts > 0
+        if node.function == "count":
+            return PatientValues(unique_ids, counts, np.ones(len(counts), dtype=bool))
+        elif node.function == "sum":
+            values = np.add.reduceat(np.where(null, 0, column), starts)
+        elif node.function == "avg":
+            sums = np.add.reduceat(np.where(null, 0, column), starts)
+            values = sums / np.maximum(counts, 1)
+        elif node.function in ("min", "max"):
+            key = get_numeric_sort_key(column, null_first=node.function == "max")
+            function = np.maximum if node.function == "max" else np.minimum
+            if key is not None:
+                values = column[get_first_in_group(key, function, starts)]
+            else:
+                # Sort NULLs to the opposite end to the value we want so that
+                # they only get selected if every value is NULL
+                not_null_key = null if node.function == "min" else ~null
+                order = np.lexsort([sortable(column, null), not_null_key, patient_ids])
+                if node.function == "min":
+                    values = column[order[starts]]
+                else:
+                    values = column[order[get_group_ends(starts, len(order))]]
+        else:
+            raise ValueError(f"Unsupported aggregate function: {node.function}")
+        return PatientValues(unique_ids, values, valid)
+
+
+def compare(column, operator_name, value):
+    result = OPERATORS[operator_name](column, value)
+    # Comparisons involving NULLs are never true
+    return np.asarray(result, dtype=bool) & ~is_null(column)
+
+
+def lookup(patient_values, patient_ids):
+    """
+    Return the values for each of the given patient_ids (which need not be
+    unique or sorted) along with a mask which is False wherever the value is
+    NULL or the patient has no value at all
+    """
+    if len(patient_values.patient_ids) == 0:
+        values = np.zeros(len(patient_ids), dtype=patient_values.values.dtype)
+        return values, np.zeros(len(patient_ids), dtype=bool)
+    positions = np.searchsorted(patient_values.patient_ids, patient_ids)
+    positions = np.minimum(positions, len(patient_values.patient_ids) - 1)
+    found = patient_values.patient_ids[positions] == patient_ids
+    values = patient_values.values[positions]
+    return values, found & patient_values.valid[positions]
+
+
+def get_group_ends(starts, length):
+    """
+    Return the index of the last element of each group, given the index of the
+    first element of each group
+    """
+    return np.append(starts[1:], length) - 1
+
+
+def get_first_in_group(key, function, starts):
+    """
+    Return the index of the first element in each group whose `key` is the
+    result of reducing the group with `function` (e.g. `np.minimum`)
+    """
+    if len(key) == 0:
+        return np.zeros(0, dtype=np.intp)
+    best = function.reduceat(key, starts)
+    group_sizes = np.diff(np.append(starts, len(key)))
+    candidates = np.flatnonzero(key == np.repeat(best, group_sizes))
+    groups = np.searchsorted(starts, candidates, side="right") - 1
+    is_first = np.concatenate([[True], groups[1:] != groups[:-1]])
+    return candidates[is_first]
+
+
+def get_numeric_sort_key(column, null_first=True):
+    """
+    Return an array of numbers which sort in the same order as `column`, with
+    NULLs first (or last, if `null_first` is False), or None if the column isn't
+    of a numeric type
+    """
+    kind = column.dtype.kind
+    if kind == "f":
+        return np.where(np.isnan(column), -np.inf if null_first else np.inf, column)
+    elif kind in "mM":
+        key = column.view(np.int64)
+        # NaT is already the smallest possible value
+        if not null_first:
+            key = np.where(np.isnat(column), np.iinfo(np.int64).max, key)
+        return key
+    elif kind in "iub":
+        return column
+    else:
+        return None
+
+
+def get_group_starts(sorted_ids):
+    """
+    Return the index of the first element of each run of identical values in
+    `sorted_ids`
+    """
+    if len(sorted_ids) == 0:
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]]))
+
+
+def is_null(array):
+    kind = array.dtype.kind
+    if kind in "fc":
+        return np.isnan(array)
+    elif kind in "mM":
+        return np.isnat(array)
+    elif kind == "O":
+        return array == None  # noqa: E711
+    else:
+        return np.zeros(len(array), dtype=bool)
+
+
+def sortable(array, null):
+    """
+    Return a version of `array` which can be sorted, given that NULLs are
+    sorted separately using the `null` mask
+    """
+    # Python objects can't be compared with None so we replace NULLs with an
+    # arbitrary non-NULL value
+    if array.dtype.kind == "O" and null.any() and not null.all():
+        array = array.copy()
+        array[null] = array[~null][0]
+    return array
@@ -1,39 +1,163 @@
+import contextlib
+import graphlib
+import math
+import queue
+import secrets
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import sqlalchemy
 import sqlalchemy.dialects.mssql
 
+from cohortextractor.materialisation_cache import (
+    FINGERPRINT_VERSION,
+    get_node_fingerprints,
+)
+from cohortextractor.plan_cache import (
+    CompiledPlan,
+    describe_backend_tables,
+    get_qualified_name,
+)
+from cohortextractor.query_engines.base import QueryEngineBase
+from cohortextractor.serialization import get_fingerprint
 from cohortextractor.sqlalchemy_utils import (
+    make_codelist_table_expression,
     make_table_expression,
     get_joined_tables,
     get_primary_table,
 )
 
 from cohortextractor.query_lang import (
-    QueryNode,
     Value,
     ValueFromRow,
     ValueFromAggregate,
     Column,
     BaseTable,
+    Codelist,
     FilteredTable,
+    QueryNode,
     Row,
+    get_filter_key,
+    walk_query_dag,
 )
 
 
-class QueryEngine:
+class QueryEngine(QueryEngineBase):
 
     sqlalchemy_dialect = sqlalchemy.dialects.mssql
 
-    def __init__(self, column_definitions, backend):
-        """
-        `column_definitions` is a dictionary mapping output column names to
-        Values, which are leaf nodes in DAG of QueryNodes
+    # Number of rows fetched from the database at a time when streaming results
+    batch_size = 10000
 
-        `backend` is a Backend instance
-        """
-        self.column_definitions = column_definitions
-        self.backend = backend
+    # Number of database connections used when executing. If this is greater
+    # than one then independent temporary tables are populated concurrently,
+    # which requires them to be created as global temporary tables so they are
+    # visible across connections
+    max_workers = 1
+
+    # How to index the `patient_id` column of each temporary table so that the
+    # joins against them can use merge joins and seeks rather than hash joins
+    # over full scans. One of:
+    #   "auto": a unique clustered index where the table is known to contain a
+    #       single row per patient, otherwise a non-unique clustered index
+    #   "clustered": a non-unique clustered index on every table
+    #   None: leave every table as an unindexed heap
+    temp_table_index = "auto"
+
+    # If True, the population table is populated first and every other table is
+    # restricted to just those patients in the population, rather than being
+    # built for every patient in the database
+    population_first = False
+
+    # If True, aggregates over different filters of the same base table (e.g.
+    # counts of events matching several different codes) are calculated in a
+    # single query using conditional aggregates, rather than a separate query
+    # and temporary table for each
+    fuse_aggregates = False
+
+    # Maximum number of codes inserted into a codelist table per statement
+    codelist_batch_size = 1000
+
+    # Collation of the codes in codelist tables. Codes such as CTV3 codes are
+    # case-sensitive, so this must be case-sensitive (otherwise codes which
+    # differ only in case would clash in the primary key) and it must match
+    # the collation of the backend's code columns so that they can be compared.
+    codelist_collation = "Latin1_General_CS_AS"
+
+    # If set to a pair `(index, count)` then every query is restricted to
+    # patients whose `patient_id` modulo `count` equals `index` (see
+    # `iter_sharded_results`)
+    shard = None
+
+    # If set, a callable which is passed a dictionary describing each stage of
+    # execution (uploading a codelist, populating a temporary table, running
+    # the results query) as it completes, with its wall time and the number of
+    # rows it wrote (see `cohortextractor.tracing`)
+    tracer = None
+
+    # If True (and `tracer` is set), the database's estimated execution plan
+    # for each query is included in the events passed to `tracer`
+    trace_plans = False
+
+    # If set, a MaterialisationCache in which temporary tables are kept between
+    # runs, so that each is only rebuilt when the part of the cohort it is
+    # derived from, or the data, changes (see
+    # `cohortextractor.materialisation_cache`)
+    materialisation_cache = None
+
+    # If False, tables aren't evicted from the materialisation cache at the
+    # end of the run. Shards are run with this set, so that one shard can't
+    # evict tables which another has built but not yet read, and the tables
+    # are evicted once every shard has finished (see `iter_sharded_results`).
+    cache_eviction = True
+
+    # If True, groups whose tables would only be referenced once (either by the
+    # results query or by the query for a single other group) are inlined into
+    # that query as a derived table, rather than being materialised into a
+    # temporary table of their own. This saves writing and indexing the table
+    # and a round trip to the database for each such group.
+    inline_groups = False
+
+    # Optional dictionary mapping backend table names to their approximate
+    # number of rows. If given then groups are only inlined if the table they
+    # select from has no more than `inline_row_limit` rows, as larger tables
+    # are better scanned once into an indexed temporary table.
+    table_statistics = None
+    inline_row_limit = 1_000_000
+
+    # If set, the results are built in stages whenever they are selected from
+    # more than this many tables. Each batch of this many tables is joined to
+    # the population in an intermediate temporary table (indexed like any
+    # other), and then those tables are joined in batches in turn until few
+    # enough remain to join in a single query. This keeps the size of every
+    # query bounded, however many columns the cohort has.
+    results_join_batch_size = None
+
+    # SQLAlchemy compiles joins recursively, so it can't generate a query which
+    # joins more than a few hundred tables. Results are always built in stages
+    # of at most this many tables (as if `results_join_batch_size` were set)
+    # when they would otherwise be selected from more.
+    max_results_join_size = 200
+
+    # If set to a pair `(since, until)` of watermark values then only patients
+    # with rows which were added or changed after `since` and no later than
+    # `until`, according to the backend's watermark columns, are included (see
+    # `iter_incremental_results`)
+    changed_between = None
+
+    def __init__(self, column_definitions, backend, **options):
+        super().__init__(column_definitions, backend, **options)
+        batch_size = self.results_join_batch_size
+        if batch_size is not None and (
+            not isinstance(batch_size, int) or batch_size < 2
+        ):
+            # Joining stages in batches of one would never reduce their number
+            raise ValueError(
+                "results_join_batch_size must be an integer of at least 2, got"
+                f" {batch_size!r}"
+            )
 
         # Walk over all nodes in the query DAG looking for output nodes (leaf
         # nodes which represent a value or a column of values) and group them
@@ -41,57 +165,245 @@ class QueryEngine:
         # which they are derived). Each such group of outputs can be generated
         # by a single query so we want them grouped together.
         output_groups = defaultdict(list)
-        for node in self.walk_query_dag(column_definitions.values()):
+        for node in walk_query_dag(column_definitions.values()):
             if self.is_output_node(node):
                 output_groups[self.get_type_and_source(node)].append(node)
 
+        # Where several rows are selected from the same table (e.g. the
+        # earliest and the latest matching event) we select them all in a
+        # single query, so we need to record which rows each group contains
+        self.row_selectors = {
+            group: list(dict.fromkeys(node.source for node in output_nodes))
+            for group, output_nodes in output_groups.items()
+            if issubclass(group[0], ValueFromRow)
+        }
+
+        # For each group of output nodes, record the other groups whose
+        # temporary tables must be populated before its own can be (because
+        # they are referenced by a filter)
+        self.group_aliases = {}
+        self.dependencies = {
+            group: self.get_dependencies(output_nodes)
+            for group, output_nodes in output_groups.items()
+        }
+
+        if self.fuse_aggregates:
+            output_groups = self.fuse_aggregate_groups(output_groups)
+
+        # Record which output columns come from each group, so that we can say
+        # which parts of the cohort each temporary table is responsible for
+        self.group_outputs = defaultdict(list)
+        for column_name, output_node in column_definitions.items():
+            self.group_outputs[self.get_group(output_node)].append(column_name)
+
+        # Work out which groups should be restricted to just those patients in
+        # the population. This can't apply to the population group itself, or
+        # to anything it depends on, as otherwise we'd have a cycle.
+        self.population_group = self.get_group(column_definitions["population"])
+        if self.population_first:
+            unrestricted = self.get_ancestor_groups(self.population_group)
+            self.restricted_groups = set(output_groups) - unrestricted
+        else:
+            self.restricted_groups = set()
+        for group in self.restricted_groups:
+            self.dependencies[group].add(self.population_group)
+
+        # Decide which groups to inline into the queries which reference them.
+        # These are removed from the dependency graph, with anything which
+        # depended on them depending on their own dependencies instead, so that
+        # the graph only contains the groups which need populating. The queries
+        # still need to be built in order of the full graph though, so that an
+        # inlined group's query exists before any query which references it.
+        build_order = list(self.get_temp_table_order())
+        self.inlined_groups = self.choose_inlined_groups(output_groups)
+        if self.inlined_groups:
+            self.dependencies = self.get_materialised_dependencies(build_order)
+
         # For each group of output nodes, make a SQLAlchemy table object
         # representing a temporary table into which we will write the required
-        # values
+        # values. If we're caching tables between runs then these are instead
+        # permanent tables named after a fingerprint of their contents.
         self.temp_tables = {}
+        self.cached_table_names = set()
+        if self.materialisation_cache is not None:
+            table_fingerprints = self.get_table_fingerprints(output_groups)
         for group, output_nodes in output_groups.items():
-            table_name = self.get_new_temporary_table_name()
+            if group in self.inlined_groups:
+                # Derived tables are only named within the query which selects
+                # from them, so this only needs to be unique within the run
+                table_name = f"inline_{self.next_counter()}"
+            elif self.materialisation_cache is not None:
+                table_name = self.materialisation_cache.get_table_name(
+                    table_fingerprints[group]
+                )
+                self.cached_table_names.add(table_name)
+            else:
+                table_name = self.get_new_temporary_table_name()
             columns = {self.get_output_column_name(output) for output in output_nodes}
             self.temp_tables[group] = make_table_expression(
                 table_name, {"patient_id"} | columns
             )
 
+        # Each distinct codelist is uploaded once into a table of its own, which
+        # is then shared by every filter which uses it
+        self.codelist_tables = {}
+        for node in walk_query_dag(column_definitions.values()):
+            if isinstance(node, Codelist) and node not in self.codelist_tables:
+                self.codelist_tables[node] = make_codelist_table_expression(
+                    self.get_new_temporary_table_name("codelist"),
+                    node.codes,
+                    self.codelist_collation,
+                )
+
+        # In incremental runs every query is restricted to just those patients
+        # whose rows have changed, so we find them first
+        self.changed_patients = None
+        if self.changed_between is not None:
+            self.changed_patients_table = make_table_expression(
+                self.get_new_temporary_table_name("changed_patients"), ["patient_id"]
+            )
+            self.changed_patients_query = self.get_changed_patients_query()
+        else:
+            self.changed_patients_table = None
+
         # For each group of output nodes, build a SQLAlchemy query expression
         # to populate the associated temporary table
-        self.temp_table_queries = {
-            group: self.get_query_expression(output_nodes)
-            for group, output_nodes in output_groups.items()
-        }
+        self.temp_table_queries = {}
+        for group in build_order:
+            query = self.get_query_expression(group, output_groups[group])
+            self.temp_table_queries[group] = query
+            if group in self.inlined_groups:
+                # Anything which references the group selects straight from its
+                # query instead
+                self.temp_tables[group] = query.alias(self.temp_tables[group].name)
 
         # `population` is a special-cased boolean column, it doesn't appear
         # itself in the output but it determines what rows are included
         column_definitions = column_definitions.copy()
         population = column_definitions.pop("population")
         is_included, population_table = self.get_value_expression(population)
+        output_columns = {
+            column_name: self.get_value_expression(output_node)
+            for column_name, output_node in column_definitions.items()
+        }
+
+        # Build big JOIN query which selects the results, staging it through
+        # intermediate tables if it would join too many tables at once
+        self.result_stages = []
+        tables = {table.name for _, table in output_columns.values()}
+        tables.discard(population_table.name)
+        batch_size = self.get_results_join_batch_size(len(tables))
+        if batch_size is not None:
+            self.results_query = self.get_staged_results_query(
+                population_table, is_included, output_columns, batch_size
+            )
+        else:
+            self.results_query = self.join_on_patient_id(
+                population_table, output_columns
+            ).where(is_included == True)
+
+    @staticmethod
+    def join_on_patient_id(driving_table, output_columns):
+        """
+        Return a query selecting `patient_id` from `driving_table` along with
+        each of `output_columns` (a dictionary mapping column names to pairs
+        of a column and its table), left joining each table on `patient_id`
+
+        We build the join in a single pass rather than extending the query one
+        table at a time, as each extension re-examines every table already
+        joined, which is quadratic in the number of tables.
+        """
+        patient_id = driving_table.c.patient_id
+        joined_tables = {driving_table.name}
+        join = driving_table
+        columns = [patient_id.label("patient_id")]
+        for column_name, (column, table) in output_columns.items():
+            if table.name not in joined_tables:
+                joined_tables.add(table.name)
+                join = sqlalchemy.join(
+                    join, table, patient_id == table.c.patient_id, isouter=True
+                )
+            columns.append(column.label(column_name))
+        return sqlalchemy.select(columns).select_from(join)
+
+    def get_results_join_batch_size(self, table_count):
+        """
+        Return the number of tables to join in each stage of building results
+        which are selected from `table_count` tables, or None if they can be
+        joined in a single query
+        """
+        batch_size = self.max_results_join_size
+        if self.results_join_batch_size is not None:
+            batch_size = min(batch_size, self.results_join_batch_size)
+        return batch_size if table_count > batch_size else None
+
+    def get_staged_results_query(
+        self, population_table, is_included, output_columns, batch_size
+    ):
+        """
+        Return a query selecting the results from a set of intermediate tables,
+        joining `batch_size` tables at a time and recording the queries which
+        populate them in `result_stages` (see `results_join_batch_size`)
+        """
+        # Group the columns by the table they come from, so that each table is
+        # joined in exactly one batch. Columns from the population table itself
+        # could go in any batch so they go in the first.
+        columns_by_table = defaultdict(dict)
+        for column_name, (column, table) in output_columns.items():
+            columns_by_table[table.name][column_name] = (column, table)
+        population_columns = columns_by_table.pop(population_table.name, {})
+
+        stage_tables = []
+        for i, batch in enumerate(
+            get_batches(list(columns_by_table.values()), batch_size)
+        ):
+            columns = dict(population_columns) if i == 0 else {}
+            for table_columns in batch:
+                columns.update(table_columns)
+            query = self.join_on_patient_id(population_table, columns)
+            query = query.where(is_included == True)
+            stage_tables.append(self.add_result_stage(query, columns))
+
+        # Every intermediate table has exactly one row for each patient in the
+        # population, so from here on they can be joined to each other directly
+        while len(stage_tables) > batch_size:
+            stage_tables = [
+                self.add_result_stage(self.join_result_stages(batch))
+                for batch in get_batches(stage_tables, batch_size)
+            ]
+        return self.join_result_stages(stage_tables, column_names=output_columns)
 
-        # Build big JOIN query which selects the results
-        results_query = (
-            sqlalchemy.select([population_table.c.patient_id.label("patient_id")])
-            .select_from(population_table)
-            .where(is_included == True)
+    def join_result_stages(self, stage_tables, column_names=None):
+        tables_by_column = {
+            column.name: table
+            for table in stage_tables
+            for column in table.columns
+            if column.name != "patient_id"
+        }
+        if column_names is None:
+            column_names = tables_by_column
+        output_columns = {
+            column_name: (
+                tables_by_column[column_name].c[column_name],
+                tables_by_column[column_name],
+            )
+            for column_name in column_names
+        }
+        return self.join_on_patient_id(stage_tables[0], output_columns)
+
+    def add_result_stage(self, query, column_names=None):
+        if column_names is None:
+            column_names = [
+                column.name
+                for column in query.selected_columns
+                if column.name != "patient_id"
+            ]
+        table = make_table_expression(
+            self.get_new_temporary_table_name("results"),
+            ["patient_id", *column_names],
         )
-        for column_name, output_node in column_definitions.items():
-            column, table = self.get_value_expression(output_node)
-            results_query = self.include_joined_table(results_query, table)
-            results_query = results_query.add_columns(column.label(column_name))
-
-        self.results_query = results_query
-
-    def walk_query_dag(self, nodes):
-        parents = []
-        for node in nodes:
-            yield node
-            for attr in ("source", "value"):
-                reference = getattr(node, attr, None)
-                if isinstance(reference, QueryNode):
-                    parents.append(reference)
-        if parents:
-            yield from self.walk_query_dag(parents)
+        self.result_stages.append((table, query))
+        return table
 
     @staticmethod
     def is_output_node(node):
@@ -99,19 +411,211 @@ class QueryEngine:
 
     def get_type_and_source(self, node):
         assert self.is_output_node(node)
+        if isinstance(node, ValueFromRow):
+            # Values from rows are grouped by the table the row is selected
+            # from, rather than by the row itself, so that different rows from
+            # the same table can be selected in a single pass
+            return (type(node), node.source.source)
         return (type(node), node.source)
 
-    @staticmethod
-    def get_output_column_name(node):
+    def get_group(self, node):
+        """
+        Return the group whose temporary table contains the given output node
+        """
+        group = self.get_type_and_source(node)
+        return self.group_aliases.get(group, group)
+
+    def get_output_column_name(self, node):
         if isinstance(node, ValueFromAggregate):
+            group = self.get_type_and_source(node)
+            if group in self.group_aliases:
+                # Disambiguate the same aggregate applied to different filters
+                fused_groups = self.fused_groups[self.group_aliases[group]]
+                return f"{node.column}_{node.function}_{fused_groups.index(group) + 1}"
             return f"{node.column}_{node.function}"
-        elif isinstance(node, (ValueFromRow, Column)):
+        elif isinstance(node, ValueFromRow):
+            row_selectors = self.row_selectors[self.get_type_and_source(node)]
+            if len(row_selectors) == 1:
+                return node.column
+            # Disambiguate the same column selected from different rows
+            return f"{node.column}_row{row_selectors.index(node.source) + 1}"
+        elif isinstance(node, Column):
             return node.column
         else:
             raise TypeError(f"Unhandled type: {node}")
 
-    def get_new_temporary_table_name(self):
-        return f"#temp_table_{self.next_counter()}"
+    def get_dependencies(self, output_nodes):
+        query_nodes = {self.get_type_and_source(node)[1] for node in output_nodes}
+        dependencies = set()
+        for query_node in query_nodes:
+            for node in self.get_node_list(query_node):
+                value = getattr(node, "value", None)
+                if self.is_output_node(value):
+                    dependencies.add(self.get_group(value))
+        return dependencies
+
+    def fuse_aggregate_groups(self, output_groups):
+        """
+        Merge aggregate groups over the same base table into a single group,
+        returning the new output groups and updating the dependency graph
+
+        Groups are only merged if they are at the same depth in the dependency
+        graph which guarantees that none of them depend on each other (so the
+        graph remains acyclic)
+        """
+        depths = {}
+        for group in self.get_temp_table_order():
+            depths[group] = max(
+                (depths[dependency] + 1 for dependency in self.dependencies[group]),
+                default=0,
+            )
+
+        candidates = defaultdict(list)
+        for group in output_groups:
+            output_type, query_node = group
+            if issubclass(output_type, ValueFromAggregate):
+                base_table = self.get_node_list(query_node)[0]
+                candidates[(output_type, base_table, depths[group])].append(group)
+
+        self.fused_groups = {}
+        for fused_group, groups in candidates.items():
+            if len(groups) > 1:
+                self.fused_groups[fused_group] = groups
+                for group in groups:
+                    self.group_aliases[group] = fused_group
+
+        fused_output_groups = defaultdict(list)
+        for group, output_nodes in output_groups.items():
+            fused_output_groups[self.group_aliases.get(group, group)].extend(
+                output_nodes
+            )
+        self.dependencies = {
+            group: self.get_dependencies(output_nodes)
+            for group, output_nodes in fused_output_groups.items()
+        }
+        return fused_output_groups
+
+    def get_ancestor_groups(self, group):
+        """
+        Return the given group plus all the groups it depends on, directly or
+        indirectly
+        """
+        ancestors = set()
+        to_visit = [group]
+        while to_visit:
+            group = to_visit.pop()
+            if group not in ancestors:
+                ancestors.add(group)
+                to_visit.extend(self.dependencies[group])
+        return ancestors
+
+    def get_table_fingerprints(self, output_groups):
+        """
+        Return a dictionary mapping each group to a fingerprint of everything
+        which determines the contents of its table
+        """
+        node_fingerprints = get_node_fingerprints(self.column_definitions.values())
+        context_fingerprint = get_fingerprint(
+            {
+                "version": FINGERPRINT_VERSION,
+                "query_engine": get_qualified_name(type(self)),
+                "dialect": self.sqlalchemy_dialect.dialect.name,
+                "backend": get_qualified_name(type(self.backend)),
+                "tables": describe_backend_tables(self.backend),
+                "shard": self.shard,
+                "changed_between": self.changed_between,
+            }
+        )
+        population = self.column_definitions["population"]
+        table_fingerprints = {}
+        for group, output_nodes in output_groups.items():
+            columns = {
+                self.get_output_column_name(output_node): node_fingerprints[output_node]
+                for output_node in output_nodes
+            }
+            if group in self.restricted_groups:
+                restriction = node_fingerprints[population]
+            else:
+                restriction = None
+            table_fingerprints[group] = get_fingerprint(
+                [context_fingerprint, columns, restriction]
+            )
+        return table_fingerprints
+
+    def choose_inlined_groups(self, output_groups):
+        """
+        Return the set of groups which should be inlined into the queries which
+        reference them rather than materialised
+
+        A group can only be inlined if its table is referenced by just one
+        other query, as otherwise the database would have to evaluate it more
+        than once. If we have table statistics then it must also be cheap to
+        evaluate.
+        """
+        if not self.inline_groups:
+            return set()
+        # The results query joins each table once, however many of its
+        # columns are selected
+        reference_counts = defaultdict(int)
+        for output_node in self.column_definitions.values():
+            reference_counts[self.get_group(output_node)] = 1
+        # Unless the results are staged, in which case the population table is
+        # joined to every stage which selects directly from the groups' tables
+        # (see `get_staged_results_query`)
+        joined_groups = set(reference_counts) - {self.population_group}
+        batch_size = self.get_results_join_batch_size(len(joined_groups))
+        if batch_size is not None:
+            stages = math.ceil(len(joined_groups) / batch_size)
+            reference_counts[self.population_group] += stages - 1
+        for dependencies in self.dependencies.values():
+            for dependency in dependencies:
+                reference_counts[dependency] += 1
+        return {
+            group
+            for group in output_groups
+            if reference_counts[group] <= 1 and self.is_cheap_to_inline(group)
+        }
+
+    def is_cheap_to_inline(self, group):
+        if self.table_statistics is None:
+            return True
+        if group in self.group_aliases.values():
+            _, base_table, _ = group
+        else:
+            base_table = self.get_node_list(group[1])[0]
+        rows = self.table_statistics.get(base_table.name)
+        return rows is not None and rows <= self.inline_row_limit
+
+    def get_materialised_dependencies(self, build_order):
+        """
+        Return the dependency graph with the inlined groups removed, so that
+        each group which is materialised depends on the materialised groups
+        referenced by its own query or by any group inlined into it
+        """
+        dependencies = {}
+        for group in build_order:
+            dependencies[group] = set()
+            for dependency in self.dependencies[group]:
+                if dependency in self.inlined_groups:
+                    dependencies[group].update(dependencies[dependency])
+                else:
+                    dependencies[group].add(dependency)
+        return {
+            group: group_dependencies
+            for group, group_dependencies in dependencies.items()
+            if group not in self.inlined_groups
+        }
+
+    def get_new_temporary_table_name(self, prefix="temp_table"):
+        if self.max_workers > 1:
+            # Global temporary tables are visible to every session so they need
+            # names which won't clash with those from other runs
+            try:
+                run_id = self._run_id
+            except AttributeError:
+                run_id = self._run_id = secrets.token_hex(4)
+            return f"##{prefix}_{run_id}_{self.next_counter()}"
+        return f"#{prefix}_{self.next_counter()}"
 
     def next_counter(self):
         try:
@@ -120,10 +624,11 @@ class QueryEngine:
             self._counter = 1
         return self._counter
 
-    def get_query_expression(self, output_nodes):
-        # output_nodes must all be of the same group so we arbitrarily use the
-        # first one
-        output_type, query_node = self.get_type_and_source(output_nodes[0])
+    def get_query_expression(self, group, output_nodes):
+        if group in self.group_aliases.values():
+            return self.get_fused_aggregate_expression(group, output_nodes)
+
+        output_type, query_node = group
 
         # Queries (currently) always have a linear structure so we can
         # decompose them into a list
@@ -131,27 +636,39 @@ class QueryEngine:
         # The start of the list should always be a BaseTable
         base_table = node_list.pop(0)
         assert isinstance(base_table, BaseTable)
-        # If there's an operation applied to reduce the results to a single row
-        # per patient, then that will be the final element of the list
-        row_selector = None
-        if issubclass(output_type, ValueFromRow):
-            row_selector = node_list.pop()
-            assert isinstance(row_selector, Row)
         # All remaining nodes should be filter operations
         filters = node_list
         assert all(isinstance(f, FilteredTable) for f in filters)
 
         selected_columns = {node.column for node in output_nodes}
-        query = self.get_select_expression(base_table, selected_columns)
+        required_columns = {filter_node.column for filter_node in filters}
+        if issubclass(output_type, ValueFromRow):
+            for row_selector in self.row_selectors[group]:
+                required_columns.update(row_selector.sort_columns)
+        query = self.get_select_expression(
+            base_table, selected_columns, required_columns, filters
+        )
+        query = self.apply_patient_restrictions(group, query)
         for filter_node in filters:
             query = self.apply_filter(query, filter_node)
 
-        if row_selector is not None:
-            query = self.apply_row_selector(
-                query,
-                sort_columns=row_selector.sort_columns,
-                descending=row_selector.descending,
-            )
+        # If there are operations applied to reduce the results to a single row
+        # per patient then apply them
+        if issubclass(output_type, ValueFromRow):
+            row_selectors = self.row_selectors[group]
+            if all(
+                self.is_reducible_to_aggregate(base_table, row_selector, output_nodes)
+                for row_selector in row_selectors
+            ):
+                query = self.apply_row_aggregates(query, output_nodes)
+            elif len(row_selectors) == 1:
+                query = self.apply_row_selector(
+                    query,
+                    sort_columns=row_selectors[0].sort_columns,
+                    descending=row_selectors[0].descending,
+                )
+            else:
+                query = self.apply_row_selectors(query, row_selectors, output_nodes)
 
         if issubclass(output_type, ValueFromAggregate):
             query = self.apply_aggregates(query, output_nodes)
@@ -168,16 +685,136 @@ class QueryEngine:
             else:
                 node = node.source
         node_list.reverse()
-        return node_list
+        # Filters are combined with AND so applying the same filter a second
+        # time has no effect, and we drop any repeats here rather than when the
+        # filters are applied so that building long chains stays linear
+        seen_filters = set()
+        deduplicated = []
+        for node in node_list:
+            if isinstance(node, FilteredTable):
+                key = get_filter_key(node)
+                if key in seen_filters:
+                    continue
+                seen_filters.add(key)
+            deduplicated.append(node)
+        return deduplicated
 
-    def get_select_expression(self, base_table, columns):
+    def get_select_expression(
+        self, base_table, columns, required_columns=(), filters=()
+    ):
+        """
+        Return a query selecting `columns` from the given table
+
+        The backend only reads `columns` plus `required_columns` (the other
+        columns which the rest of the query refers to), and any of `filters`
+        which compare a column with a literal value are pushed down into its
+        query for the table so that it can skip rows as early as possible. The
+        filters must still be applied to the returned query.
+        """
         columns = {"patient_id"}.union(columns)
-        table_expr = self.backend.get_table_expression(base_table.name)
+        predicates = [
+            (filter_node.column, filter_node.operator, filter_node.value)
+            for filter_node in filters
+            if self.is_literal_filter(filter_node)
+        ]
+        table_expr = self.backend.get_table_expression(
+            base_table.name, columns.union(required_columns), predicates
+        )
         column_objs = [table_expr.c[column] for column in columns]
         query = sqlalchemy.select(column_objs).select_from(table_expr)
         return query
 
+    @staticmethod
+    def is_literal_filter(filter_node):
+        return not isinstance(filter_node.value, (QueryNode, list, tuple))
+
+    def apply_patient_restrictions(self, group, query):
+        if group in self.restricted_groups:
+            query = self.apply_population_restriction(query)
+        if self.shard is not None:
+            query = self.apply_shard_restriction(query)
+        if self.changed_patients_table is not None:
+            query = self.apply_changed_patients_restriction(query)
+        return query
+
+    def apply_changed_patients_restriction(self, query):
+        changed_ids = sqlalchemy.select([self.changed_patients_table.c.patient_id])
+        table_expr = get_primary_table(query)
+        return query.where(table_expr.c.patient_id.in_(changed_ids))
+
+    def get_changed_patients_query(self):
+        """
+        Return a query selecting the IDs of the patients with rows, in any of
+        the tables the cohort uses, whose watermarks lie in `changed_between`
+        """
+        since, until = self.changed_between
+        table_names = dict.fromkeys(
+            node.name
+            for node in walk_query_dag(self.column_definitions.values())
+            if type(node) is BaseTable
+        )
+        queries = []
+        for table_name in table_names:
+            watermarks = self.backend.get_table(table_name).watermarks
+            if not watermarks:
+                raise ValueError(
+                    f"Table '{table_name}' has no watermark columns so can't be"
+                    " used in incremental runs"
+                )
+            # The backend can only push down predicates which all apply, so it
+            # can't help when there are several watermarks to check
+            predicates = []
+            if len(watermarks) == 1:
+                predicates = [
+                    (watermarks[0], "__gt__", since),
+                    (watermarks[0], "__le__", until),
+                ]
+            table_expr = self.backend.get_table_expression(
+                table_name, watermarks, predicates
+            )
+            is_changed = sqlalchemy.or_(
+                *[
+                    sqlalchemy.and_(
+                        table_expr.c[watermark] > since,
+                        table_expr.c[watermark] <= until,
+                    )
+                    for watermark in watermarks
+                ]
+            )
+            query = sqlalchemy.select([table_expr.c.patient_id]).where(is_changed)
+            if self.shard is not None:
+                query = self.apply_shard_restriction(query)
+            queries.append(query)
+        if len(queries) == 1:
+            return queries[0].distinct()
+        return sqlalchemy.union(*queries)
+
+    def apply_shard_restriction(self, query):
+        index, count = self.shard
+        table_expr = get_primary_table(query)
+        return query.where(table_expr.c.patient_id.op("%")(count) == index)
+
+    def apply_population_restriction(self, query):
+        # Semi-join against the population so we only scan rows belonging to
+        # patients who will appear in the results
+        is_included, population_table = self.get_value_expression(
+            self.column_definitions["population"]
+        )
+        population_ids = sqlalchemy.select([population_table.c.patient_id]).where(
+            is_included == True
+        )
+        table_expr = get_primary_table(query)
+        return query.where(table_expr.c.patient_id.in_(population_ids))
+
     def apply_filter(self, query, filter_node):
+        query, condition = self.get_filter_condition(query, filter_node)
+        return query.where(condition)
+
+    def get_filter_condition(self, query, filter_node):
+        """
+        Return the condition expressing the given filter, along with the query
+        updated to include any tables the condition references
+        """
         column_name = filter_node.column
         operator_name = filter_node.operator
         value_expr, other_table = self.get_value_expression(filter_node.value)
@@ -185,36 +822,145 @@ class QueryEngine:
             query = self.include_joined_table(query, other_table)
         table_expr = get_primary_table(query)
         column = table_expr.c[column_name]
+        if isinstance(filter_node.value, Codelist):
+            return query, self.get_codelist_condition(
+                table_expr, column, operator_name, filter_node.value
+            )
         method = getattr(column, operator_name)
-        return query.where(method(value_expr))
+        return query, method(value_expr)
+
+    def get_codelist_condition(self, table_expr, column, operator_name, codelist):
+        if operator_name != "__eq__":
+            raise ValueError("Codelists can only be used in equality filters")
+        system = self.backend.get_table(table_expr.name).columns[column.name].system
+        if system is not None and system != codelist.system:
+            raise ValueError(
+                f"Cannot filter '{table_expr.name}.{column.name}' ({system} codes)"
+                f" using a {codelist.system} codelist"
+            )
+        # Semi-join against the uploaded codes
+        codelist_table = self.codelist_tables[codelist]
+        return column.in_(sqlalchemy.select([codelist_table.c.code]))
 
     def get_value_expression(self, value):
         if self.is_output_node(value):
-            table = self.temp_tables[self.get_type_and_source(value)]
+            table = self.temp_tables[self.get_group(value)]
             column = self.get_output_column_name(value)
             value_expr = table.c[column]
             return value_expr, table
         else:
             return value, None
 
-    @staticmethod
-    def apply_row_selector(query, sort_columns, descending):
+    @classmethod
+    def apply_row_selector(cls, query, sort_columns, descending):
         table_expr = get_primary_table(query)
         column_names = [column.name for column in query.selected_columns]
-        order_columns = [table_expr.c[column] for column in sort_columns]
-        if descending:
-            order_columns = [c.desc() for c in order_columns]
-        row_num = (
-            sqlalchemy.func.row_number()
-            .over(order_by=order_columns, partition_by=table_expr.c.patient_id)
-            .label("_row_num")
-        )
-        query = query.add_columns(row_num)
+        row_num = cls.get_row_number(table_expr, sort_columns, descending)
+        query = query.add_columns(row_num.label("_row_num"))
         subquery = query.alias()
         query = sqlalchemy.select([subquery.c[column] for column in column_names])
         query = query.select_from(subquery).where(subquery.c._row_num == 1)
         return query
 
+    def apply_row_selectors(self, query, row_selectors, output_nodes):
+        """
+        Select several different rows per patient in a single pass over the
+        table by numbering the rows within a separate window for each row
+        selector and then pivoting the selected rows into a single row per
+        patient
+        """
+        table_expr = get_primary_table(query)
+        row_num_labels = {}
+        for i, row_selector in enumerate(row_selectors, start=1):
+            row_num_labels[row_selector] = f"_row_num_{i}"
+            row_num = self.get_row_number(
+                table_expr, row_selector.sort_columns, row_selector.descending
+            )
+            query = query.add_columns(row_num.label(row_num_labels[row_selector]))
+        subquery = query.alias()
+
+        columns = [subquery.c.patient_id]
+        for output_node in dict.fromkeys(output_nodes):
+            row_num = subquery.c[row_num_labels[output_node.source]]
+            value = sqlalchemy.case([(row_num == 1, subquery.c[output_node.column])])
+            column_type = self.backend.get_column_type(
+                table_expr.name, output_node.column
+            )
+            # There is at most one non-NULL value per patient so any aggregate
+            # which ignores NULLs will do, but SQL Server doesn't allow MAX on
+            # BIT columns so booleans have to be round-tripped via integers
+            if column_type == "boolean":
+                value = sqlalchemy.cast(
+                    sqlalchemy.func.max(sqlalchemy.cast(value, sqlalchemy.Integer)),
+                    sqlalchemy.Boolean,
+                )
+            else:
+                value = sqlalchemy.func.max(value)
+            columns.append(value.label(self.get_output_column_name(output_node)))
+
+        query = sqlalchemy.select(columns).select_from(subquery)
+        query = query.where(
+            sqlalchemy.or_(
+                *[subquery.c[label] == 1 for label in row_num_labels.values()]
+            )
+        )
+        query = query.group_by(subquery.c.patient_id)
+        return query
+
+    def is_reducible_to_aggregate(self, base_table, row_selector, output_nodes):
+        """
+        If the only column we need from a row is the single column it's sorted
+        by then, rather than sorting, we can just take the MIN or MAX of that
+        column which is much cheaper
+        """
+        if len(row_selector.sort_columns) != 1:
+            return False
+        sort_column = row_selector.sort_columns[0]
+        # SQL Server doesn't support MIN/MAX on BIT columns
+        if self.backend.get_column_type(base_table.name, sort_column) == "boolean":
+            return False
+        return all(
+            output_node.column == sort_column
+            for output_node in output_nodes
+            if output_node.source == row_selector
+        )
+
+    def apply_row_aggregates(self, query, output_nodes):
+        columns = []
+        for output_node in dict.fromkeys(output_nodes):
+            column = query.selected_columns[output_node.column]
+            if output_node.source.descending:
+                value = sqlalchemy.func.max(column)
+            else:
+                value = self.get_min_sorting_nulls_first(column)
+            columns.append(value.label(self.get_output_column_name(output_node)))
+        query = query.with_only_columns([query.selected_columns.patient_id] + columns)
+        query = query.group_by(query.selected_columns.patient_id)
+        return query
+
+    @staticmethod
+    def get_min_sorting_nulls_first(column):
+        # SQL Server sorts NULLs first in ascending order, so the first row by
+        # this column will have a NULL value if any of them do. MIN ignores
+        # NULLs so we need to check for them explicitly to get the same result.
+        return sqlalchemy.case(
+            [
+                (
+                    sqlalchemy.func.count() == sqlalchemy.func.count(column),
+                    sqlalchemy.func.min(column),
+                )
+            ]
+        )
+
+    @staticmethod
+    def get_row_number(table_expr, sort_columns, descending):
+        order_columns = [table_expr.c[column] for column in sort_columns]
+        if descending:
+            order_columns = [c.desc() for c in order_columns]
+        return sqlalchemy.func.row_number().over(
+            order_by=order_columns, partition_by=table_expr.c.patient_id
+        )
+
     def apply_aggregates(self, query, aggregate_nodes):
         columns = [
             self.get_aggregate_column(query, aggregate_node)
@@ -224,6 +970,88 @@ class QueryEngine:
         query = query.group_by(query.selected_columns.patient_id)
         return query
 
+    def get_fused_aggregate_expression(self, group, output_nodes):
+        """
+        Calculate aggregates over several different filters of the same base
+        table in a single pass, by making each aggregate conditional on the
+        filters which apply to it
+        """
+        _, base_table, _ = group
+        filters = {}
+        for output_node in output_nodes:
+            if output_node.source not in filters:
+                filters[output_node.source] = self.get_node_list(output_node.source)[1:]
+        # Filters which apply to every aggregate can go in the WHERE clause
+        common_filters = set.intersection(
+            *[
+                {get_filter_key(filter_node) for filter_node in filter_nodes}
+                for filter_nodes in filters.values()
+            ]
+        )
+
+        selected_columns = {node.column for node in output_nodes}
+        required_columns = {
+            filter_node.column
+            for filter_nodes in filters.values()
+            for filter_node in filter_nodes
+        }
+        common_filter_nodes = [
+            filter_node
+            for filter_node in next(iter(filters.values()))
+            if get_filter_key(filter_node) in common_filters
+        ]
+        query = self.get_select_expression(
+            base_table, selected_columns, required_columns, common_filter_nodes
+        )
+        query = self.apply_patient_restrictions(group, query)
+        for filter_node in common_filter_nodes:
+            query = self.apply_filter(query, filter_node)
+
+        conditions = {}
+        for source, filter_nodes in filters.items():
+            clauses = []
+            for filter_node in filter_nodes:
+                if get_filter_key(filter_node) not in common_filters:
+                    query, clause = self.get_filter_condition(query, filter_node)
+                    clauses.append(clause)
+            conditions[source] = sqlalchemy.and_(*clauses) if clauses else None
+
+        columns = [
+            self.get_conditional_aggregate_column(
+                query, output_node, conditions[output_node.source]
+            )
+            for output_node in dict.fromkeys(output_nodes)
+        ]
+        query = query.with_only_columns([query.selected_columns.patient_id] + columns)
+        query = query.group_by(query.selected_columns.patient_id)
+        return query
+
+    def get_conditional_aggregate_column(self, query, aggregate_node, condition):
+        if condition is None:
+            return self.get_aggregate_column(query, aggregate_node)
+        output_column = self.get_output_column_name(aggregate_node)
+        source_column = query.selected_columns[aggregate_node.column]
+        # Patients with no matching rows should get NULL rather than a value,
+        # just as if they were missing from a separate temporary table
+        matches = sqlalchemy.case([(condition, 1)])
+        if aggregate_node.function == "exists":
+            value = sqlalchemy.func.max(matches)
+        elif aggregate_node.function == "count":
+            value = sqlalchemy.case(
+                [
+                    (
+                        sqlalchemy.func.count(matches) > 0,
+                        sqlalchemy.func.count(
+                            sqlalchemy.case([(condition, source_column)])
+                        ),
+                    )
+                ]
+            )
+        else:
+            function = getattr(sqlalchemy.func, aggregate_node.function)
+            value = function(sqlalchemy.case([(condition, source_column)]))
+        return value.label(output_column)
+
     def get_aggregate_column(self, query, aggregate_node):
         output_column = self.get_output_column_name(aggregate_node)
         if aggregate_node.function == "exists":
@@ -246,19 +1074,643 @@ class QueryEngine:
         return query.select_from(join)
 
     def get_sql(self):
-        sql = []
-        for group, table in self.temp_tables.items():
-            query = self.temp_table_queries[group]
-            query_sql = self.query_expression_to_sql(query)
-            sql.append(f"SELECT * INTO {table.name} FROM (\n{query_sql}\n) t")
+        sql = list(self.get_codelist_statements())
+        sql.extend(self.get_temp_table_statements())
         sql.append(self.query_expression_to_sql(self.results_query))
 
         return "\n\n\n".join(sql)
 
+    def get_plan(self):
+        """
+        Return a CompiledPlan containing all the SQL needed to run the cohort,
+        which can be cached and executed without a query engine (see
+        `cohortextractor.plan_cache`)
+        """
+        if self.materialisation_cache is not None:
+            raise ValueError("Plans can't be compiled using a materialisation cache")
+        temp_tables = []
+        if self.changed_patients_table is not None:
+            temp_tables.append(
+                {
+                    "table": self.changed_patients_table.name,
+                    "statements": self.get_changed_patients_statements(),
+                    "dependencies": [],
+                }
+            )
+        for group in self.get_temp_table_order():
+            dependencies = self.dependencies[group]
+            temp_tables.append(
+                {
+                    "table": self.temp_tables[group].name,
+                    "statements": self.get_group_statements(group),
+                    "dependencies": sorted(
+                        self.temp_tables[dependency].name for dependency in dependencies
+                    ),
+                }
+            )
+        for table, query in self.result_stages:
+            temp_tables.append(
+                {
+                    "table": table.name,
+                    "statements": self.get_result_stage_statements(table, query),
+                    "dependencies": self.get_result_stage_dependencies(query),
+                }
+            )
+        return CompiledPlan(
+            codelist_statements=list(self.get_codelist_statements()),
+            temp_tables=temp_tables,
+            results_sql=self.query_expression_to_sql(self.results_query),
+            drop_statements=list(self.get_drop_table_statements()),
+        )
+
+    def get_codelist_statements(self):
+        for codelist, table in self.codelist_tables.items():
+            yield self.make_codelist_table_sql(table)
+            for batch in self.get_codelist_batches(codelist):
+                yield self.query_expression_to_sql(table.insert().values(batch))
+
+    def get_codelist_batches(self, codelist):
+        codes = list(dict.fromkeys(codelist.codes))
+        for i in range(0, len(codes), self.codelist_batch_size):
+            yield [{"code": code} for code in codes[i : i + self.codelist_batch_size]]
+
+    def make_codelist_table_sql(self, table):
+        return self.query_expression_to_sql(sqlalchemy.schema.CreateTable(table))
+
+    def upload_codelists(self, connection):
+        # Rather than executing the literal SQL from `get_codelist_statements`
+        # we bind the codes as parameters so the driver can insert them in
+        # bulk (see `get_sqlalchemy_engine`)
+        for codelist, table in self.codelist_tables.items():
+            start = time.perf_counter()
+            connection.exec_driver_sql(self.make_codelist_table_sql(table))
+            rows = 0
+            for batch in self.get_codelist_batches(codelist):
+                connection.execute(table.insert(), batch)
+                rows += len(batch)
+            if self.tracer is not None:
+                self.trace(
+                    event="codelist",
+                    table=table.name,
+                    system=codelist.system,
+                    seconds=time.perf_counter() - start,
+                    rows=rows,
+                )
+
+    def get_temp_table_statements(self):
+        yield from self.get_changed_patients_statements()
+        for group in self.get_temp_table_order():
+            yield from self.get_group_statements(group)
+        for table, query in self.result_stages:
+            yield from self.get_result_stage_statements(table, query)
+
+    def get_temp_table_order(self):
+        """
+        Return the groups in an order in which their temporary tables can be
+        populated i.e. with every group after all the groups it depends on
+        """
+        return graphlib.TopologicalSorter(self.dependencies).static_order()
+
+    def get_group_statements(self, group):
+        table = self.temp_tables[group]
+        query = self.temp_table_queries[group]
+        unique = self.is_one_row_per_patient(group)
+        return self.get_table_statements(table, query, unique)
+
+    def get_result_stage_statements(self, table, query):
+        # Result stages always have a single row per patient
+        return self.get_table_statements(table, query, unique=True)
+
+    def get_table_statements(self, table, query, unique):
+        statements = [self.make_temp_table_sql(table, query)]
+        if self.temp_table_index == "auto":
+            statements.append(self.make_index_sql(table, unique=unique))
+        elif self.temp_table_index == "clustered":
+            statements.append(self.make_index_sql(table, unique=False))
+        elif self.temp_table_index is not None:
+            raise ValueError(f"Unknown index strategy: {self.temp_table_index}")
+        return statements
+
+    @staticmethod
+    def is_one_row_per_patient(group):
+        output_type = group[0]
+        return issubclass(output_type, Value)
+
+    def make_temp_table_sql(self, table, query):
+        query_sql = self.query_expression_to_sql(query)
+        return f"SELECT * INTO {table.name} FROM (\n{query_sql}\n) t"
+
+    def make_index_sql(self, table, unique):
+        unique = "UNIQUE " if unique else ""
+        return (
+            f"CREATE {unique}CLUSTERED INDEX ix_patient_id ON {table.name} (patient_id)"
+        )
+
+    def get_drop_table_statements(self):
+        for table in self.get_tables_to_drop():
+            yield f"DROP TABLE IF EXISTS {table.name}"
+
+    def get_tables_to_drop(self):
+        """
+        Return the tables which should be dropped once the results have been
+        fetched, which excludes any kept in the materialisation cache
+        """
+        temp_tables = [
+            table
+            for group, table in self.temp_tables.items()
+            if group not in self.inlined_groups
+            and table.name not in self.cached_table_names
+        ]
+        stage_tables = [table for table, _ in self.result_stages]
+        if self.changed_patients_table is not None:
+            stage_tables.append(self.changed_patients_table)
+        return [*self.codelist_tables.values(), *temp_tables, *stage_tables]
+
     def query_expression_to_sql(self, query):
         return str(
             query.compile(
-                dialect=self.sqlalchemy_dialect.dialect(),
+                dialect=self.get_dialect(),
                 compile_kwargs={"literal_binds": True},
             )
         )
+
+    def get_dialect(self):
+        dialect = self.sqlalchemy_dialect.dialect()
+        # Every version of SQL Server we target supports multi-row VALUES
+        # clauses, but the dialect can't know that until it has connected
+        dialect.supports_multivalues_insert = True
+        return dialect
+
+    def execute(self, connection):
+        """
+        Materialise all temporary tables using `connection` and then run the
+        results query, returning a SQLAlchemy result object from which rows
+        can be fetched
+
+        Temporary tables are scoped to the connection so the caller is
+        responsible for keeping it open until all rows have been fetched
+        """
+        self.upload_codelists(connection)
+        self.materialise(connection)
+        return self.get_results(connection)
+
+    def materialise(self, connection):
+        """
+        Populate every temporary table, in order, using `connection`, which
+        must already have the codelist tables
+        """
+        self.populate_changed_patients(connection)
+        for group in self.get_temp_table_order():
+            self.populate_group(connection, group)
+        self.populate_result_stages(connection)
+        self.evict_cached_tables(connection)
+
+    def execute_concurrently(self, connections):
+        """
+        Materialise all temporary tables using as many of `connections` in
+        parallel as the dependencies between them allow and then run the
+        results query using the first connection
+
+        All connections must be kept open until all rows have been fetched as
+        global temporary tables are dropped when the session which created
+        them ends
+        """
+        with connections[0].begin():
+            self.upload_codelists(connections[0])
+            self.populate_changed_patients(connections[0])
+            if self.materialisation_cache is not None:
+                # Make sure the cache is ready before any of the workers use it
+                self.get_cache_data_version(connections[0])
+
+        idle_connections = queue.Queue()
+        for connection in connections:
+            idle_connections.put(connection)
+
+        def populate(group):
+            connection = idle_connections.get()
+            try:
+                # Each table must be committed before any other connection can
+                # read from it
+                with connection.begin():
+                    self.populate_group(connection, group)
+            finally:
+                idle_connections.put(connection)
+
+        sorter = graphlib.TopologicalSorter(self.dependencies)
+        sorter.prepare()
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            running = {}
+            while sorter.is_active():
+                for group in sorter.get_ready():
+                    running[executor.submit(populate, group)] = group
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    group = running.pop(future)
+                    # Re-raises any exception from the worker
+                    future.result()
+                    sorter.done(group)
+
+        with connections[0].begin():
+            self.populate_result_stages(connections[0])
+            self.evict_cached_tables(connections[0])
+        return self.get_results(connections[0])
+
+    def populate_group(self, connection, group):
+        table = self.temp_tables[group]
+        cache = self.materialisation_cache
+        if cache is not None:
+            data_version = self.get_cache_data_version(connection)
+            if cache.lookup(connection, table.name, data_version):
+                if self.tracer is not None:
+                    self.trace(
+                        event="cached_table",
+                        table=table.name,
+                        outputs=self.group_outputs.get(group, []),
+                    )
+                return
+            # Clear out anything left behind by a run which failed before the
+            # table was fully populated (which is only safe because the cache
+            # is never shared between concurrent runs)
+            cache.drop_table(connection, table.name)
+
+        statements = self.get_group_statements(group)
+        if self.tracer is None and cache is None:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+            return
+
+        if self.tracer is not None:
+            event = {
+                "event": "temp_table",
+                "table": table.name,
+                "outputs": self.group_outputs.get(group, []),
+                "columns": [column.name for column in table.columns],
+                "sources": self.describe_group(group),
+                "dependencies": sorted(
+                    self.temp_tables[dependency].name
+                    for dependency in self.dependencies[group]
+                ),
+            }
+            if self.trace_plans:
+                event["plan"] = self.get_query_plan(connection, statements[0])
+        seconds, rows = self.execute_table_statements(connection, table, statements)
+        if cache is not None:
+            cache.store(connection, table.name, data_version, rows)
+        if self.tracer is not None:
+            self.trace(**event, seconds=seconds, rows=rows)
+
+    def get_changed_patients_statements(self):
+        if self.changed_patients_table is None:
+            return []
+        return self.get_table_statements(
+            self.changed_patients_table, self.changed_patients_query, unique=True
+        )
+
+    def populate_changed_patients(self, connection):
+        """
+        Populate the table of patients whose rows have changed, if this is an
+        incremental run, and record their IDs in `changed_patients`
+        """
+        table = self.changed_patients_table
+        if table is None:
+            return
+        statements = self.get_changed_patients_statements()
+        seconds, rows = self.execute_table_statements(connection, table, statements)
+        if self.tracer is not None:
+            self.trace(
+                event="changed_patients",
+                table=table.name,
+                changed_between=list(self.changed_between),
+                seconds=seconds,
+                rows=rows,
+            )
+        result = connection.execute(sqlalchemy.select([table.c.patient_id]))
+        self.changed_patients = {patient_id for (patient_id,) in result}
+
+    def populate_result_stages(self, connection):
+        for table, query in self.result_stages:
+            statements = self.get_result_stage_statements(table, query)
+            if self.tracer is None:
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+                continue
+            event = {
+                "event": "results_stage",
+                "table": table.name,
+                "columns": [column.name for column in table.columns],
+                "dependencies": self.get_result_stage_dependencies(query),
+            }
+            if self.trace_plans:
+                event["plan"] = self.get_query_plan(connection, statements[0])
+            seconds, rows = self.execute_table_statements(connection, table, statements)
+            self.trace(**event, seconds=seconds, rows=rows)
+
+    @staticmethod
+    def get_result_stage_dependencies(query):
+        # Inlined groups are joined as derived tables rather than tables, and
+        # don't need populating
+        return sorted(
+            table.name
+            for table in get_joined_tables(query)
+            if isinstance(table, sqlalchemy.Table)
+        )
+
+    def execute_table_statements(self, connection, table, statements):
+        """
+        Execute the statements which populate `table`, returning the time they
+        took and the number of rows written
+        """
+        start = time.perf_counter()
+        rows = connection.exec_driver_sql(statements[0]).rowcount
+        for statement in statements[1:]:
+            connection.exec_driver_sql(statement)
+        seconds = time.perf_counter() - start
+        # Not every driver reports the number of rows a statement wrote
+        if rows is None or rows < 0:
+            rows = self.count_rows(connection, table)
+        return seconds, rows
+
+    def get_cache_data_version(self, connection):
+        # The data version is fixed for the duration of a run so we only need
+        # to ask for it (and clear out stale tables) once
+        try:
+            return self._cache_data_version
+        except AttributeError:
+            cache = self.materialisation_cache
+            self._cache_data_version = cache.prepare(connection)
+            return self._cache_data_version
+
+    def evict_cached_tables(self, connection):
+        if self.materialisation_cache is not None and self.cache_eviction:
+            self.materialisation_cache.evict(connection, keep=self.cached_table_names)
+
+    def get_results(self, connection):
+        results_sql = self.query_expression_to_sql(self.results_query)
+        event = {"event": "results"}
+        if self.tracer is not None and self.trace_plans:
+            event["plan"] = self.get_query_plan(connection, results_sql)
+        connection = connection.execution_options(stream_results=True)
+        start = time.perf_counter()
+        result = connection.exec_driver_sql(results_sql)
+        if self.tracer is not None:
+            # This only covers executing the query; the time taken to fetch
+            # the rows is reported separately by `iter_result_batches`
+            self.trace(**event, seconds=time.perf_counter() - start)
+        return result
+
+    def get_query_plan(self, connection, sql):
+        """
+        Return the database's estimated execution plan for `sql`, without
+        executing it
+        """
+        connection.exec_driver_sql("SET SHOWPLAN_XML ON")
+        try:
+            return connection.exec_driver_sql(sql).scalar()
+        finally:
+            connection.exec_driver_sql("SET SHOWPLAN_XML OFF")
+
+    @staticmethod
+    def count_rows(connection, table):
+        query = sqlalchemy.select([sqlalchemy.func.count()]).select_from(table)
+        return connection.execute(query).scalar()
+
+    def trace(self, **event):
+        if self.shard is not None:
+            event["shard"] = list(self.shard)
+        self.tracer(event)
+
+    def describe_group(self, group):
+        """
+        Return a list of short descriptions of the tables (or rows of tables)
+        from which the given group's outputs are derived
+        """
+        if group in self.group_aliases.values():
+            groups = self.fused_groups[group]
+        else:
+            groups = [group]
+        descriptions = []
+        for output_type, query_node in groups:
+            if issubclass(output_type, ValueFromRow):
+                row_selectors = self.row_selectors[(output_type, query_node)]
+                descriptions.extend(self.describe_node(row) for row in row_selectors)
+            else:
+                descriptions.append(self.describe_node(query_node))
+        return descriptions
+
+    def describe_node(self, query_node):
+        """
+        Return a short description of a table or row node e.g.
+
+            clinical_events[code = codelist(ctv3: XE2q5)].last_by(date)
+        """
+        node_list = self.get_node_list(query_node)
+        description = node_list[0].name
+        for node in node_list[1:]:
+            if isinstance(node, FilteredTable):
+                operator = OPERATOR_SYMBOLS[node.operator]
+                value = self.describe_value(node.value)
+                description += f"[{node.column} {operator} {value}]"
+            elif isinstance(node, Row):
+                method = "first_by" if node.descending else "last_by"
+                description += f".{method}({', '.join(node.sort_columns)})"
+        return description
+
+    def describe_value(self, value):
+        if isinstance(value, Codelist):
+            codes = ", ".join(value.codes[:3])
+            if len(value.codes) > 3:
+                codes += f", ... ({len(value.codes)} codes)"
+            return f"codelist({value.system}: {codes})"
+        elif self.is_output_node(value):
+            table = self.temp_tables[self.get_group(value)]
+            return f"{table.name}.{self.get_output_column_name(value)}"
+        else:
+            return repr(value)
+
+    def iter_result_batches(self, batch_size=None):
+        """
+        Run the query against the backend's database and yield the results as
+        lists of at most `batch_size` rows, so that the full result set never
+        needs to be held in memory
+        """
+        batch_size = batch_size or self.batch_size
+        engine = self.backend.get_sqlalchemy_engine()
+        with contextlib.ExitStack() as stack:
+            connections = [
+                stack.enter_context(engine.connect()) for _ in range(self.max_workers)
+            ]
+            # Connections are returned to the pool rather than closed so we
+            # need to clean up after ourselves
+            stack.callback(self.drop_temp_tables, connections[0])
+            if len(connections) > 1:
+                result = self.execute_concurrently(connections)
+            else:
+                result = self.execute(connections[0])
+            stack.enter_context(contextlib.closing(result))
+            start = time.perf_counter()
+            total_rows = 0
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                total_rows += len(rows)
+                yield rows
+            if self.tracer is not None:
+                # Note this includes any time the caller spent processing each
+                # batch before asking for the next one
+                self.trace(
+                    event="results_fetched",
+                    seconds=time.perf_counter() - start,
+                    rows=total_rows,
+                )
+
+    def iter_results(self, batch_size=None):
+        for rows in self.iter_result_batches(batch_size):
+            yield from rows
+
+    def iter_sharded_results(
+        self, shards, parallel_shards=1, batch_size=None, shard_indexes=None
+    ):
+        """
+        Run the query separately for each of `shards` disjoint subsets of
+        patients, streaming the rows from every shard into a single result
+
+        This bounds the size of the temporary tables by the size of a shard
+        rather than of the whole database. Shards are independent, so up to
+        `parallel_shards` of them are run at once and, if a shard fails, just
+        that shard can be re-run by passing its index in `shard_indexes`.
+        Rows are yielded in no particular order.
+        """
+        if shard_indexes is None:
+            shard_indexes = range(shards)
+        # Workers block once this many batches are waiting to be consumed so
+        # that memory use stays bounded however fast the shards run
+        messages = queue.Queue(maxsize=parallel_shards * 2)
+        cancelled = threading.Event()
+        # The materialisation cache tables used by every shard
+        cached_table_names = set()
+
+        def send(message):
+            while not cancelled.is_set():
+                try:
+                    messages.put(message, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise ShardCancelled()
+
+        def run_shard(index):
+            # Shards which were queued before another failed (or the consumer
+            # stopped) may still be started, so there's no point running them
+            if cancelled.is_set():
+                return
+            try:
+                engine = self.get_shard_engine(index, shards)
+                cached_table_names.update(engine.cached_table_names)
+                with contextlib.closing(engine.iter_result_batches(batch_size)) as it:
+                    for rows in it:
+                        send(("rows", index, rows))
+            except ShardCancelled:
+                return
+            except Exception as e:
+                send(("done", index, e))
+            else:
+                send(("done", index, None))
+
+        if self.materialisation_cache is not None:
+            # Shards running in parallel would otherwise race to create the
+            # registry and clear out stale tables, so do that once up front
+            with self.backend.get_sqlalchemy_engine().begin() as connection:
+                self.get_cache_data_version(connection)
+
+        with ThreadPoolExecutor(max_workers=parallel_shards) as executor:
+            for index in shard_indexes:
+                executor.submit(run_shard, index)
+            try:
+                remaining = len(shard_indexes)
+                while remaining:
+                    kind, index, payload = messages.get()
+                    if kind == "rows":
+                        yield from payload
+                    elif payload is not None:
+                        raise RuntimeError(
+                            f"Shard {index} of {shards} failed, re-run it with"
+                            f" shard_indexes=[{index}]"
+                        ) from payload
+                    else:
+                        remaining -= 1
+                if self.materialisation_cache is not None:
+                    with self.backend.get_sqlalchemy_engine().begin() as connection:
+                        self.materialisation_cache.evict(
+                            connection, keep=cached_table_names
+                        )
+            finally:
+                cancelled.set()
+                # Don't wait for queued shards to start only to be cancelled
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_incremental_results(self, previous_results, since, until, batch_size=None):
+        """
+        Update the results of a previous run of the same cohort, by re-running
+        it for just those patients whose rows were added or changed after the
+        watermark `since` and no later than `until`, and yielding those
+        patients' new rows along with the previous rows for every other patient
+
+        `previous_results` is an iterable of the previous rows, each of which
+        must be a mapping with a `patient_id` key. Previous rows are streamed
+        straight through, so only the rows for changed patients are held in
+        memory, and run time scales with the number of changed patients rather
+        than the size of the population. `until` should be passed as `since`
+        to the next incremental run.
+
+        Note that rows which are deleted from the database aren't detected,
+        nor are rows whose watermarks fall outside the window (e.g. because
+        they were backdated).
+        """
+        query_engine = self.get_incremental_engine(since, until)
+        changed_rows = list(query_engine.iter_results(batch_size))
+        changed_patients = query_engine.changed_patients
+        for row in previous_results:
+            # Previous results may have been read from a text format such as CSV
+            if int(row["patient_id"]) not in changed_patients:
+                yield row
+        yield from changed_rows
+
+    def get_incremental_engine(self, since, until):
+        return type(self)(
+            self.column_definitions,
+            self.backend,
+            **{**self.options, "changed_between": (since, until)},
+        )
+
+    def get_shard_engine(self, index, count):
+        engine = type(self)(
+            self.column_definitions,
+            self.backend,
+            **{**self.options, "shard": (index, count), "cache_eviction": False},
+        )
+        if self.materialisation_cache is not None:
+            # Every shard uses the data version prepared by `iter_sharded_results`
+            engine._cache_data_version = self._cache_data_version
+        return engine
+
+    def drop_temp_tables(self, connection):
+        for statement in self.get_drop_table_statements():
+            connection.exec_driver_sql(statement)
+
+
+def get_batches(items, batch_size):
+    return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+OPERATOR_SYMBOLS = {
+    "__eq__": "=",
+    "__lt__": "<",
+    "__le__": "<=",
+    "__gt__": ">",
+    "__ge__": ">=",
+}
+
+
+class ShardCancelled(Exception):
+    pass
@@ -0,0 +1,64 @@
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+
+from cohortextractor.query_engines import mssql
+
+
+class QueryEngine(mssql.QueryEngine):
+    """
+    Query engine which runs the same queries as the MSSQL engine against a
+    SQLite database (either a file or `:memory:`), for running cohorts locally
+    and measuring the effect of changes to the generated SQL
+    """
+
+    sqlalchemy_dialect = sqlalchemy.dialects.sqlite
+
+    # SQLite compares strings case-sensitively by default
+    codelist_collation = None
+
+    def __init__(self, column_definitions, backend, **options):
+        super().__init__(column_definitions, backend, **options)
+        # SQLite only allows a single writer at a time so there's nothing to be
+        # gained by populating tables concurrently
+        if self.max_workers > 1:
+            raise ValueError("SQLite query engine does not support max_workers > 1")
+
+    def get_new_temporary_table_name(self, prefix="temp_table"):
+        # SQLite marks temporary tables in the CREATE statement rather than by
+        # their names
+        return f"{prefix}_{self.next_counter()}"
+
+    def make_temp_table_sql(self, table, query):
+        query_sql = self.query_expression_to_sql(query)
+        # Tables kept in the materialisation cache must outlive the connection
+        temp = "" if table.name in self.cached_table_names else "TEMP "
+        return f"CREATE {temp}TABLE {self.quote(table.name)} AS {query_sql}"
+
+    def make_codelist_table_sql(self, table):
+        sql = super().make_codelist_table_sql(table)
+        return sql.replace("CREATE TABLE", "CREATE TEMP TABLE", 1)
+
+    def make_index_sql(self, table, unique):
+        # SQLite has no clustered indexes, but an index on `patient_id` still
+        # turns the joins against each temporary table into index lookups
+        unique = "UNIQUE " if unique else ""
+        index_name = self.quote(f"ix_{table.name}_patient_id")
+        return f"CREATE {unique}INDEX {index_name} ON {self.quote(table.name)} (patient_id)"
+
+    def get_drop_table_statements(self):
+        for table in self.get_tables_to_drop():
+            yield f"DROP TABLE IF EXISTS {self.quote(table.name)}"
+
+    def get_query_plan(self, connection, sql):
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        # Each step of the plan refers to its parent step, with the top-level
+        # steps having a parent of 0
+        depths = {0: -1}
+        lines = []
+        for step_id, parent_id, _, detail in rows:
+            depths[step_id] = depths.get(parent_id, -1) + 1
+            lines.append("  " * depths[step_id] + detail)
+        return "\n".join(lines)
+
+    def quote(self, name):
+        return self.get_dialect().identifier_preparer.quote(name)
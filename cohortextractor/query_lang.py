@@ -1,3 +1,6 @@
+import operator as op
+import threading
+
 __all__ = ["table", "codelist"]
 
 
@@ -5,25 +8,108 @@ def table(table_name):
     return BaseTable(table_name)
 
 
-def codelist(*args, **kwargs):
-    pass
+def codelist(codes, system):
+    return Codelist(codes, system)
 
 
 class QueryNode:
+    # Nodes are compared and hashed structurally rather than by identity, so
+    # that separately constructed but identical queries are treated as the same
+    # query (and so only ever get executed once).
+    #
+    # Large studies can involve hundreds of thousands of nodes so we keep them
+    # compact by storing their attributes (listed in `_fields` by each
+    # subclass) in slots. Nodes are immutable, which means we can calculate
+    # their hashes once, on construction.
+
+    __slots__ = ("_hash", "_equal_to")
+    _fields = ()
+
+    def _init(self, *values):
+        """
+        Set the node's attributes to `values` (in the order given by `_fields`)
+        and calculate its hash
+        """
+        frozen_values = []
+        for name, value in zip(self._fields, values):
+            if isinstance(value, list):
+                value = tuple(value)
+            _setattr(self, name, value)
+            frozen_values.append(_freeze(value))
+        # This must match `_structural_key`. Every node's parents are
+        # constructed (and so hashed) before it is, so this never needs to
+        # recurse.
+        _setattr(self, "_hash", hash((type(self), tuple(frozen_values))))
+        _setattr(self, "_equal_to", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} objects are immutable")
+
+    def __reduce__(self):
+        # The default implementation would try to set attributes directly
+        return (type(self).from_dict, (self.to_dict(),))
+
     def to_dict(self):
-        return vars(self)
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(self) is not type(other):
+            return NotImplemented
+        return _structurally_equal(self, other)
+
+    def _structural_key(self, parents=None):
+        """
+        Return a hashable representation of the node's type and attributes
+
+        If `parents` is a list then any nodes among the attributes are replaced
+        by a placeholder and appended to `parents` instead
+        """
+        return (
+            type(self),
+            tuple(_freeze(getattr(self, name), parents) for name in self._fields),
+        )
 
     @classmethod
     def from_dict(cls, dictionary):
+        if set(dictionary) != set(cls._fields):
+            raise TypeError(
+                f"{cls.__name__} requires attributes {', '.join(cls._fields)}, got"
+                f" {', '.join(dictionary)}"
+            )
+        return cls.from_values([dictionary[name] for name in cls._fields])
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Construct a node from a sequence of its attribute values, in the order
+        given by `_fields`
+        """
+        if len(values) != len(cls._fields):
+            raise TypeError(
+                f"{cls.__name__} requires {len(cls._fields)} attributes, got"
+                f" {len(values)}"
+            )
         obj = cls.__new__(cls)
-        for key, value in dictionary.items():
-            setattr(obj, key, value)
+        obj._init(*values)
         return obj
 
 
+_setattr = object.__setattr__
+
+
 class BaseTable(QueryNode):
+    __slots__ = _fields = ("name",)
+
     def __init__(self, name):
-        self.name = name
+        self._init(name)
 
     def get(self, column):
         return Column(source=self, column=column)
@@ -92,41 +178,179 @@ class BaseTable(QueryNode):
 
 
 class FilteredTable(BaseTable):
+    __slots__ = _fields = ("source", "column", "operator", "value")
+
     def __init__(self, source, column, operator, value):
-        self.source = source
-        self.column = column
-        self.operator = operator
-        self.value = value
+        self._init(source, column, operator, value)
 
 
 class Row(QueryNode):
+    __slots__ = _fields = ("source", "sort_columns", "descending")
+
     def __init__(self, source, sort_columns, descending=False):
-        self.source = source
-        self.sort_columns = sort_columns
-        self.descending = descending
+        self._init(source, tuple(sort_columns), descending)
 
     def get(self, column):
         return ValueFromRow(source=self, column=column)
 
 
 class Column(QueryNode):
+    __slots__ = _fields = ("source", "column")
+
     def __init__(self, source, column):
-        self.source = source
-        self.column = column
+        self._init(source, column)
+
+
+class Codelist(QueryNode):
+    __slots__ = _fields = ("codes", "system")
+
+    def __init__(self, codes, system):
+        self._init(tuple(codes), system)
 
 
 class Value(QueryNode):
-    pass
+    __slots__ = ()
 
 
 class ValueFromRow(Value):
+    __slots__ = _fields = ("source", "column")
+
     def __init__(self, source, column):
-        self.source = source
-        self.column = column
+        self._init(source, column)
 
 
 class ValueFromAggregate(Value):
+    __slots__ = _fields = ("source", "function", "column")
+
     def __init__(self, source, function, column):
-        self.source = source
-        self.function = function
-        self.column = column
+        self._init(source, function, column)
+
+
+# The function implementing each of the operators which filters can apply, for
+# anything which evaluates filters outside the database
+OPERATORS = {
+    "__eq__": op.eq,
+    "__lt__": op.lt,
+    "__le__": op.le,
+    "__gt__": op.gt,
+    "__ge__": op.ge,
+}
+
+
+def get_filter_key(filter_node):
+    """
+    Return a hashable representation of the condition a FilteredTable applies,
+    which is the same for any two filters with the same effect
+    """
+    return (filter_node.column, filter_node.operator, _freeze(filter_node.value))
+
+
+def get_parents(node):
+    """
+    Return the nodes which `node` is directly derived from
+    """
+    parents = []
+    for attr in ("source", "value"):
+        reference = getattr(node, attr, None)
+        if isinstance(reference, QueryNode):
+            parents.append(reference)
+    return parents
+
+
+def walk_query_dag(nodes):
+    """
+    Yield every node in the DAG leading to `nodes`, exactly once each, in
+    topological order (i.e. every node comes after the nodes it is derived
+    from)
+
+    This walks the DAG with an explicit stack rather than recursing so that
+    long chains of nodes can't exceed Python's recursion limit, and remembers
+    where it has been so that nodes shared between many paths through the DAG
+    are only visited once.
+    """
+    visited = set()
+    # Each entry is a node plus a flag saying whether its parents have already
+    # been pushed onto the stack (in which case the node is ready to yield)
+    stack = [(node, False) for node in reversed(list(nodes))]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            yield node
+        elif node not in visited:
+            visited.add(node)
+            stack.append((node, True))
+            for parent in reversed(get_parents(node)):
+                if parent not in visited:
+                    stack.append((parent, False))
+
+
+# Comparisons temporarily link nodes which may turn out not to be equal, so
+# only one may run at a time
+_equality_lock = threading.Lock()
+
+
+def _structurally_equal(node, other):
+    # Rather than comparing structural keys directly (which would recurse
+    # through every pair of ancestors) we compare each pair of nodes in turn
+    # with an explicit stack
+    with _equality_lock:
+        return _compare_dags(node, other)
+
+
+def _compare_dags(node, other):
+    linked = []
+    stack = [(node, other)]
+    while stack:
+        node, other = stack.pop()
+        node, other = _get_representative(node), _get_representative(other)
+        if node is other:
+            continue
+        parents, other_parents = [], []
+        if (
+            type(node) is not type(other)
+            or hash(node) != hash(other)
+            or node._structural_key(parents) != other._structural_key(other_parents)
+        ):
+            # Undo any links made below as they assumed the DAGs were equal
+            for linked_node in linked:
+                _setattr(linked_node, "_equal_to", None)
+            return False
+        # Link the nodes straight away, on the assumption that their parents
+        # will turn out to be equal too, so that we compare each pair of nodes
+        # only once however many paths through the DAG lead to them
+        _setattr(node, "_equal_to", other)
+        linked.append(node)
+        stack.extend(zip(parents, other_parents))
+    return True
+
+
+def _get_representative(node):
+    """
+    Return the node which `node` has been found to be equal to, if any
+
+    Comparing two separately constructed but equal DAGs means comparing every
+    pair of corresponding nodes, so we remember the result to make any later
+    comparisons between their descendants cheap
+    """
+    while node._equal_to is not None:
+        node = node._equal_to
+    return node
+
+
+def _freeze(value, parents=None):
+    """
+    Return a hashable representation of an attribute value for use in
+    structural comparisons (see `QueryNode._structural_key`)
+    """
+    if isinstance(value, QueryNode):
+        if parents is None:
+            return value
+        parents.append(value)
+        return QueryNode
+    elif isinstance(value, (list, tuple)):
+        # Lists and tuples are interchangeable (not least because tuples become
+        # lists after a round-trip through JSON)
+        return (list, tuple(_freeze(item, parents) for item in value))
+    else:
+        # Include the type so that e.g. `True` and `1` are not treated as equal
+        return (type(value), value)
@@ -1,6 +1,11 @@
+import hashlib
+import json
+
 from cohortextractor.query_lang import (
     QueryNode,
+    walk_query_dag,
     BaseTable,
+    Codelist,
     FilteredTable,
     Row,
     Column,
@@ -8,7 +13,6 @@ from cohortextractor.query_lang import (
     ValueFromAggregate,
 )
 
-
 # Map each class in the query DAG to a (type, operation) pair to avoid leaking
 # the classes into the serialized structure
 CLASS_MAP = {
@@ -18,23 +22,31 @@ CLASS_MAP = {
     Row: ("row", "sort"),
     ValueFromRow: ("value", "row"),
     ValueFromAggregate: ("value", "aggregation"),
+    Codelist: ("codelist", "codes"),
 }
 
 CLASS_MAP_INVERSE = dict(zip(CLASS_MAP.values(), CLASS_MAP.keys()))
 assert len(CLASS_MAP) == len(CLASS_MAP_INVERSE), "CLASS_MAP must be invertable"
 
 
+def get_fingerprint(value):
+    """
+    Return a hash of the JSON representation of `value`, which is the same for
+    any two equal values (with dictionaries in any order)
+    """
+    # Values aren't necessarily JSON-serializable, but any which aren't should
+    # at least have a stable string representation
+    value_json = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value_json.encode("utf-8")).hexdigest()
+
+
 def cohort_definition_to_dict(cohort_definition):
-    # Give every node in the DAG an ID
-    nodes = walk_query_dag(cohort_definition.values())
-    node_ids = {}
-    i = 0
-    # Iterating backwards gives a more logical order to the output so that
-    # nodes are defined before they are referenced
-    for node in reversed(list(nodes)):
-        if node not in node_ids:
-            i += 1
-            node_ids[node] = f"#{i}"
+    # Give every node in the DAG an ID, numbering them in topological order so
+    # that nodes are defined before they are referenced
+    node_ids = {
+        node: f"#{i}"
+        for i, node in enumerate(walk_query_dag(cohort_definition.values()), 1)
+    }
 
     nodes_as_dicts = {
         node_id: node_as_dict(node, node_ids) for node, node_id in node_ids.items()
@@ -50,10 +62,9 @@ def cohort_definition_to_dict(cohort_definition):
 
 
 def cohort_definition_from_dict(data):
-    node_defs = data["nodes"]
-    nodes = {}
+    nodes = nodes_from_dict(data["nodes"])
     return {
-        column: attr_from_dict(value, node_defs, nodes)
+        column: attr_from_dict(value, nodes)
         for (column, value) in data["outputs"].items()
     }
 
@@ -72,18 +83,6 @@ def get_class_vars(cls):
     return [(key, value) for key, value in vars(cls).items() if key not in default_vars]
 
 
-def walk_query_dag(nodes):
-    parents = []
-    for node in nodes:
-        yield node
-        for attr in ("source", "value"):
-            reference = getattr(node, attr, None)
-            if isinstance(reference, QueryNode):
-                parents.append(reference)
-    if parents:
-        yield from walk_query_dag(parents)
-
-
 def node_as_dict(node, node_ids):
     type_, operation = CLASS_MAP[node.__class__]
     return {
@@ -96,13 +95,55 @@ def node_as_dict(node, node_ids):
     }
 
 
-def node_from_dict(node_id, node_defs, nodes):
-    node_def = node_defs[node_id]
+def nodes_from_dict(node_defs):
+    """
+    Return a dictionary mapping each node ID in `node_defs` to the node it
+    defines
+    """
+    nodes = {}
+    for node_id in get_node_id_order(node_defs):
+        nodes[node_id] = node_from_dict(node_defs[node_id], nodes)
+    return nodes
+
+
+def get_node_id_order(node_defs):
+    """
+    Return the IDs of the nodes in `node_defs` in topological order (i.e. with
+    every node after all the nodes it references)
+
+    Node definitions may appear in any order so we sort them using an explicit
+    stack rather than recursion so that long chains of nodes can't exceed
+    Python's recursion limit
+    """
+    order = []
+    done = set()
+    in_progress = set()
+    for root_id in node_defs:
+        stack = [(root_id, False)]
+        while stack:
+            node_id, expanded = stack.pop()
+            if expanded:
+                order.append(node_id)
+                done.add(node_id)
+                in_progress.discard(node_id)
+                continue
+            if node_id in done:
+                continue
+            if node_id in in_progress:
+                raise ValueError(f"Node {node_id} references itself")
+            in_progress.add(node_id)
+            stack.append((node_id, True))
+            for value in node_defs[node_id]["attrs"].values():
+                if isinstance(value, dict) and value["node"] not in done:
+                    stack.append((value["node"], False))
+    return order
+
+
+def node_from_dict(node_def, nodes):
     class_id = (node_def["type"], node_def["from"])
     node_class = CLASS_MAP_INVERSE[class_id]
     attrs = {
-        key: attr_from_dict(value, node_defs, nodes)
-        for (key, value) in node_def["attrs"].items()
+        key: attr_from_dict(value, nodes) for (key, value) in node_def["attrs"].items()
     }
     return node_class.from_dict(attrs)
 
@@ -114,14 +155,8 @@ def attr_as_dict(value, node_ids):
         return value
 
 
-def attr_from_dict(value, node_defs, nodes):
+def attr_from_dict(value, nodes):
     if isinstance(value, dict):
-        node_id = value["node"]
-        if node_id in nodes:
-            return nodes[node_id]
-        else:
-            node = node_from_dict(node_id, node_defs, nodes)
-            nodes[node_id] = node
-            return node
+        return nodes[value["node"]]
     else:
         return value
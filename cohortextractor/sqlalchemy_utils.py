@@ -1,6 +1,25 @@
+import functools
+
 import sqlalchemy
 
 
+@functools.lru_cache(maxsize=None)
+def get_sqlalchemy_engine(database_url):
+    """
+    Return a SQLAlchemy engine for the given URL
+
+    Engines maintain a pool of connections so we share a single engine per URL
+    rather than creating a new one (and a new pool) for every query
+    """
+    url = sqlalchemy.engine.make_url(database_url)
+    options = {}
+    if url.get_backend_name() == "mssql" and url.get_driver_name() == "pyodbc":
+        # Without this pyodbc makes a round trip to the server for every row
+        # of an `executemany`, such as when uploading codelists
+        options["fast_executemany"] = True
+    return sqlalchemy.create_engine(url, **options)
+
+
 def make_table_expression(table_name, columns):
     """
     Return a SQLAlchemy object representing a table with the given name and
@@ -13,6 +32,24 @@ def make_table_expression(table_name, columns):
     )
 
 
+def make_codelist_table_expression(table_name, codes, collation=None):
+    """
+    Return a SQLAlchemy object representing a table with a single `code` column
+    (which is also the primary key) wide enough to hold the given codes, and
+    compared using the given collation
+    """
+    max_length = max((len(code) for code in codes), default=1)
+    return sqlalchemy.Table(
+        table_name,
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column(
+            "code",
+            sqlalchemy.String(max_length, collation=collation),
+            primary_key=True,
+        ),
+    )
+
+
 def get_joined_tables(query):
     """
     Given a query object return a list of all tables referenced
@@ -0,0 +1,28 @@
+import json
+import threading
+
+
+class JSONLinesTracer:
+    """
+    Tracer which writes each event it is passed as a single line of JSON to
+    `file` e.g.
+
+        with open("trace.jsonl", "w") as f:
+            query_engine = Backend.get_query_engine(
+                column_definitions, tracer=JSONLinesTracer(f)
+            )
+            ...
+
+    Events may arrive from several threads at once (see `max_workers`) so
+    writes are serialised with a lock.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
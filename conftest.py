@@ -0,0 +1,3 @@
+# This file makes pytest add the repository root to `sys.path`, so that the tests
+# can import `cohortextractor`, `benchmarks` and `study_definition` however
+# pytest is invoked
@@ -0,0 +1,29 @@
+import pytest
+
+from cohortextractor.backends.tpp import Backend
+
+from benchmarks import synthetic_data
+
+
+def make_backend(path):
+    backend = Backend(f"sqlite:///{path}")
+    with backend.get_sqlalchemy_engine().begin() as connection:
+        synthetic_data.generate(connection, 200, events_per_patient=10, seed=1)
+    return backend
+
+
+@pytest.fixture(scope="session")
+def backend(tmp_path_factory):
+    """
+    A backend with a small synthetic database, shared between tests so must
+    not be modified
+    """
+    return make_backend(tmp_path_factory.mktemp("data") / "test.db")
+
+
+@pytest.fixture
+def fresh_backend(tmp_path):
+    """
+    A backend with a small synthetic database of its own, which can be modified
+    """
+    return make_backend(tmp_path / "test.db")
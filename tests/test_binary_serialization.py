@@ -0,0 +1,117 @@
+import json
+import sys
+
+import pytest
+
+from cohortextractor import codelist, table
+from cohortextractor.binary_serialization import (
+    MAGIC,
+    cohort_definition_from_bytes,
+    cohort_definition_to_bytes,
+    cohort_dict_from_bytes,
+    cohort_dict_to_bytes,
+)
+from cohortextractor.serialization import (
+    cohort_class_to_definition,
+    cohort_definition_to_dict,
+)
+
+from benchmarks.cohorts import get_cohort
+
+COHORTS = ["study", "wide:20", "deep:20", "shared:20"]
+
+
+def make_golden_definition():
+    events = table("clinical_events")
+    return {
+        "population": table("practice_registrations").exists(),
+        "latest_value": events.filter(code=codelist(["XE2q5"], "ctv3"))
+        .filter("numeric_value", greater_than=-1.5)
+        .latest()
+        .get("numeric_value"),
+        "count": events.filter("date", between=["2020-01-01", "2021-01-01"]).count(),
+    }
+
+
+# The encoding of `make_golden_definition()`, which must never change as
+# definitions encoded by earlier versions must still decode the same way
+GOLDEN_BYTES = (
+    b"CXDEF\x01\x01\x06\x16practice_regist"
+    b"rations\x06\t\x00\x06\x06exists\x06\npati"
+    b"ent_id\x01\x06\x0fclinical_events"
+    b"\x07\x08\x01\x06\x05XE2q5\x06\x04ctv3\x02\t\x02\x06\x04cod"
+    b"e\x06\x06__eq__\t\x03\x02\t\x04\x06\rnumeric_"
+    b"value\x06\x06__gt__\x05\x00\x00\x00\x00\x00\x00\xf8\xbf\x04\t"
+    b"\x05\x08\x01\x06\x04date\x01\x05\t\x06\x07\x08\x02\t\x02\x07\n\x06\x06__"
+    b"ge__\x06\n2020-01-01\x02\t\x08\x07\n\x06\x06_"
+    b"_le__\x06\n2021-01-01\x06\t\t\x06\x05co"
+    b"unt\x07\x02\x00\x03\x06\npopulation\t\x01\x06\x0cl"
+    b"atest_value\t\x07\x07\x0f\t\n"
+)
+
+
+@pytest.mark.parametrize("name", COHORTS)
+def test_cohort_definition_round_trip(name):
+    definition = cohort_class_to_definition(get_cohort(name))
+    decoded = cohort_definition_from_bytes(cohort_definition_to_bytes(definition))
+    assert decoded == definition
+
+
+@pytest.mark.parametrize("name", COHORTS)
+def test_cohort_dict_round_trip(name):
+    # Tuples in the dictionary become lists, just as they would in JSON
+    data = as_json(
+        cohort_definition_to_dict(cohort_class_to_definition(get_cohort(name)))
+    )
+    assert cohort_dict_from_bytes(cohort_dict_to_bytes(data)) == data
+
+
+@pytest.mark.parametrize("name", COHORTS)
+def test_dict_and_definition_encodings_match(name):
+    definition = cohort_class_to_definition(get_cohort(name))
+    data = cohort_definition_to_dict(definition)
+    assert cohort_dict_to_bytes(data) == cohort_definition_to_bytes(definition)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [0, 127, 128, -1, -129, 2**70, -(2**70), 1.5, -0.25, None, True, False]
+    + ["", "café", "日付", "emoji 🙂", ["a", "b"], [1, -1, None]],
+)
+def test_edge_values_round_trip(value):
+    node = table("clinical_events").filter("numeric_value", equals=value)
+    definition = {"population": node.exists()}
+    decoded = cohort_definition_from_bytes(cohort_definition_to_bytes(definition))
+    decoded_value = decoded["population"].source.value
+    assert decoded == definition
+    assert type(decoded_value) is type(node.value)
+
+
+def test_chain_longer_than_recursion_limit_round_trips():
+    node = table("clinical_events")
+    for i in range(sys.getrecursionlimit() + 100):
+        node = node.filter("numeric_value", greater_than=i)
+    definition = {"population": node.exists()}
+    data = cohort_definition_to_bytes(definition)
+    assert cohort_definition_from_bytes(data) == definition
+    dict_data = as_json(cohort_definition_to_dict(definition))
+    assert cohort_dict_from_bytes(cohort_dict_to_bytes(dict_data)) == dict_data
+
+
+def as_json(data):
+    return json.loads(json.dumps(data))
+
+
+def test_golden_encoding():
+    assert cohort_definition_to_bytes(make_golden_definition()) == GOLDEN_BYTES
+    assert cohort_definition_from_bytes(GOLDEN_BYTES) == make_golden_definition()
+
+
+def test_bad_magic_is_rejected():
+    with pytest.raises(ValueError):
+        cohort_definition_from_bytes(b"NOTCX!" + GOLDEN_BYTES[len(MAGIC) :])
+
+
+def test_truncated_data_is_rejected():
+    with pytest.raises(ValueError):
+        cohort_definition_from_bytes(GOLDEN_BYTES[:-3])
@@ -0,0 +1,188 @@
+import datetime
+import io
+
+import numpy as np
+import pytest
+
+from cohortextractor.backends.tpp import Backend
+from cohortextractor.columnar import (
+    ColumnarReader,
+    ColumnarWriter,
+    get_output_types,
+)
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks.cohorts import get_cohort
+
+COLUMN_TYPES = {
+    "patient_id": "int",
+    "count": "int",
+    "value": "float",
+    "date": "date",
+    "timestamp": "datetime",
+    "flag": "boolean",
+    "stp": "categorical",
+    "code": "code",
+}
+
+
+def make_rows(count):
+    rows = []
+    for i in range(count):
+        # Every column other than `patient_id` has NULLs, in a different
+        # position for each
+        row = [
+            i,
+            i * 3 - 7,
+            i / 4,
+            datetime.date(2020, 1, 1) + datetime.timedelta(days=i),
+            # Some drivers return dates and datetimes as ISO format strings
+            f"2021-02-03 04:05:{i % 60:02d}.000001",
+            i % 3 == 0,
+            f"STP{i % 4}",
+            # Later rows introduce codes which earlier chunks never saw
+            f"X{i // 5}",
+        ]
+        if i % len(row):
+            row[i % len(row)] = None
+        rows.append(tuple(row))
+    return rows
+
+
+def write_file(path, rows, chunk_size=None, batch_size=4):
+    with open(path, "wb") as file:
+        writer = ColumnarWriter(file, COLUMN_TYPES, chunk_size)
+        for i in range(0, len(rows), batch_size):
+            writer.write_rows(rows[i : i + batch_size])
+        writer.close()
+
+
+def read_rows(reader):
+    columns = []
+    for column_name, column_type in reader.column_types.items():
+        values, valid = reader.read_column(column_name)
+        assert len(values) == len(valid) == reader.row_count
+        if column_type in ("categorical", "code"):
+            dictionary = reader.get_dictionary(column_name)
+            values = [dictionary[index] for index in values]
+        elif column_type == "date":
+            values = values.astype(object)
+        elif column_type == "datetime":
+            values = [value.item().isoformat(" ") for value in values]
+        else:
+            values = values.tolist()
+        columns.append(
+            [value if is_valid else None for value, is_valid in zip(values, valid)]
+        )
+    return list(zip(*columns))
+
+
+def normalise(rows):
+    # Datetimes are read back as `datetime` objects rather than strings
+    return [
+        tuple(
+            (
+                datetime.datetime.fromisoformat(value).isoformat(" ")
+                if column_type == "datetime" and value is not None
+                else value
+            )
+            for value, column_type in zip(row, COLUMN_TYPES.values())
+        )
+        for row in rows
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 5, 8, 100])
+def test_round_trip(tmp_path, chunk_size):
+    # 37 rows means the booleans never fill a whole number of bytes
+    rows = make_rows(37)
+    path = tmp_path / "results.cx"
+    write_file(path, rows, chunk_size)
+    reader = ColumnarReader(path)
+    assert reader.column_types == COLUMN_TYPES
+    assert reader.row_count == 37
+    assert read_rows(reader) == normalise(rows)
+
+
+def test_every_type_has_nulls():
+    rows = make_rows(37)
+    for index in range(1, len(COLUMN_TYPES)):
+        assert any(row[index] is None for row in rows)
+
+
+def test_dictionary_codes_consistent_across_chunks(tmp_path):
+    rows = make_rows(37)
+    path = tmp_path / "results.cx"
+    write_file(path, rows, chunk_size=5)
+    reader = ColumnarReader(path)
+    assert len(reader.chunks) == 8
+    dictionary = reader.get_dictionary("stp")
+    assert sorted(dictionary) == ["STP0", "STP1", "STP2", "STP3"]
+    for index in range(len(reader.chunks)):
+        values, valid = reader.read_chunk_column(index, "stp")
+        for row, value, is_valid in zip(rows[index * 5 :], values, valid):
+            if is_valid:
+                assert dictionary[value] == row[6]
+
+
+def test_booleans_are_bit_packed(tmp_path):
+    rows = make_rows(13)
+    path = tmp_path / "results.cx"
+    write_file(path, rows)
+    reader = ColumnarReader(path)
+    location = reader.chunks[0]["columns"]["flag"]["values"]
+    assert location[1] == 2
+    values, valid = reader.read_column("flag")
+    assert values.dtype == bool
+    expected = [row[5] for row in rows]
+    assert [v if ok else None for v, ok in zip(values.tolist(), valid)] == expected
+
+
+def test_empty_results(tmp_path):
+    path = tmp_path / "results.cx"
+    write_file(path, [])
+    reader = ColumnarReader(path)
+    assert reader.row_count == 0
+    assert reader.chunks == []
+    for column_name in COLUMN_TYPES:
+        values, valid = reader.read_column(column_name)
+        assert len(values) == len(valid) == 0
+    assert reader.read_column("date")[0].dtype == np.dtype("datetime64[D]")
+
+
+def test_arrays_are_aligned(tmp_path):
+    path = tmp_path / "results.cx"
+    write_file(path, make_rows(37), chunk_size=5)
+    reader = ColumnarReader(path)
+    for chunk in reader.chunks:
+        for location in chunk["columns"].values():
+            assert location["valid"][0] % 8 == 0
+            assert location["values"][0] % 8 == 0
+
+
+def test_incomplete_file_is_rejected(tmp_path):
+    file = io.BytesIO()
+    writer = ColumnarWriter(file, COLUMN_TYPES)
+    writer.write_rows(make_rows(10))
+    # Not closed, so there's no footer
+    path = tmp_path / "results.cx"
+    path.write_bytes(file.getvalue())
+    with pytest.raises(ValueError):
+        ColumnarReader(path)
+
+
+def test_unsupported_type_is_rejected():
+    with pytest.raises(ValueError):
+        ColumnarWriter(io.BytesIO(), {"patient_id": "int", "x": "decimal"})
+
+
+def test_get_output_types():
+    definition = cohort_class_to_definition(get_cohort("study"))
+    assert get_output_types(definition, Backend()) == {
+        "patient_id": "int",
+        "sgss_first_positive_test_date": "date",
+        "sgss_last_positive_test_date": "date",
+        "creatinine_value": "float",
+        "creatinine_date": "datetime",
+        "stp": "categorical",
+    }
@@ -0,0 +1,97 @@
+import datetime
+
+import numpy as np
+import pytest
+import sqlalchemy
+
+from cohortextractor.backends.base import Table
+from cohortextractor.backends.tpp import Backend
+from cohortextractor.query_engines import in_memory, sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks.cohorts import get_cohort
+
+# The dtype in which the in-memory engine expects each type of column
+DTYPES = {
+    "int": np.int64,
+    "float": np.float64,
+    "boolean": bool,
+    "date": "datetime64[D]",
+    "datetime": "datetime64[us]",
+    "code": object,
+    "categorical": object,
+}
+
+NULLS = {
+    "int": 0,
+    "float": np.nan,
+    "boolean": False,
+    "date": "NaT",
+    "datetime": "NaT",
+    "code": None,
+    "categorical": None,
+}
+
+
+@pytest.fixture(scope="module")
+def tables(backend):
+    """
+    Read every table the backend defines into arrays for the in-memory engine
+    """
+    tables = {}
+    with backend.get_sqlalchemy_engine().connect() as connection:
+        for table_name, table in vars(Backend).items():
+            if not isinstance(table, Table):
+                continue
+            column_names = list(table.get_column_names())
+            table_expr = backend.get_table_expression(table_name, column_names)
+            query = sqlalchemy.select([table_expr])
+            rows = [row._mapping for row in connection.execute(query)]
+            tables[table_name] = {}
+            for column_name in column_names:
+                column_type = table.columns[column_name].type
+                values = [
+                    NULLS[column_type] if row[column_name] is None else row[column_name]
+                    for row in rows
+                ]
+                tables[table_name][column_name] = np.array(
+                    values, dtype=DTYPES[column_type]
+                )
+    return tables
+
+
+def normalise(value):
+    # SQLite returns dates as strings and booleans as integers
+    if isinstance(value, datetime.date):
+        return value.isoformat()[:10]
+    elif isinstance(value, str) and len(value) >= 10 and value[4] == "-":
+        return value[:10]
+    elif isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def get_sorted_results(query_engine):
+    return sorted(
+        tuple(normalise(value) for value in row)
+        for row in query_engine.iter_results(batch_size=7)
+    )
+
+
+@pytest.mark.parametrize("name", ["study", "wide:20", "deep:10", "shared:10"])
+def test_in_memory_engine_matches_sqlite(backend, tables, name):
+    definition = cohort_class_to_definition(get_cohort(name))
+    expected = get_sorted_results(sqlite.QueryEngine(definition, backend))
+    results = get_sorted_results(
+        in_memory.QueryEngine(definition, Backend(), tables=tables)
+    )
+    assert len(expected) > 0
+    assert results == expected
+
+
+def test_unknown_option_is_rejected():
+    definition = cohort_class_to_definition(get_cohort("study"))
+    with pytest.raises(TypeError):
+        in_memory.QueryEngine(definition, Backend(), no_such_option=1)
@@ -0,0 +1,124 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from cohortextractor.query_engines import sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks import synthetic_data
+from benchmarks.cohorts import get_cohort
+
+# The synthetic data has nothing after the start of 2022, so everything the
+# tests add falls inside this watermark window
+SINCE = "2022-06-01"
+UNTIL = "2023-01-01"
+
+NEW_PATIENT_ID = 10_000
+
+
+def as_tuple(row):
+    # Previous rows are passed in as dictionaries and new rows are `Row`s
+    return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+
+def get_patient_with_ongoing_registration(connection):
+    registrations = synthetic_data.RegistrationHistory
+    return connection.execute(
+        sqlalchemy.select([registrations.c.patient_id])
+        .where(registrations.c.EndDate == datetime.date(9999, 12, 31))
+        # Patient 1 is given a new event, and we want to check the
+        # registration is detected by itself
+        .where(registrations.c.patient_id != 1)
+        .order_by(registrations.c.patient_id)
+        .limit(1)
+    ).scalar()
+
+
+def add_changes(connection):
+    """
+    Add rows within the watermark window, returning the IDs of the patients
+    they belong to
+    """
+    changed_patients = {}
+
+    # A new patient, with a registration and a positive test
+    connection.execute(
+        synthetic_data.RegistrationHistory.insert(),
+        [
+            dict(
+                patient_id=NEW_PATIENT_ID,
+                StartDate=datetime.date(2022, 7, 1),
+                EndDate=datetime.date(9999, 12, 31),
+                STPCode="E54000001",
+            )
+        ],
+    )
+    connection.execute(
+        synthetic_data.sgss_positive.insert(),
+        [dict(patient_id=NEW_PATIENT_ID, date=datetime.date(2022, 7, 2))],
+    )
+    changed_patients["start_date"] = NEW_PATIENT_ID
+
+    # An ongoing registration which ends, so only its end date is in the window
+    registrations = synthetic_data.RegistrationHistory
+    patient_id = get_patient_with_ongoing_registration(connection)
+    connection.execute(
+        registrations.update()
+        .where(registrations.c.patient_id == patient_id)
+        .where(registrations.c.EndDate == datetime.date(9999, 12, 31))
+        .values(EndDate=datetime.date(2022, 8, 1))
+    )
+    changed_patients["end_date"] = patient_id
+
+    # A new event for a patient who already has some
+    connection.execute(
+        synthetic_data.CodedEvents.insert(),
+        [
+            dict(
+                patient_id=1,
+                CTV3Code=synthetic_data.CODES[0],
+                ConsultationDate=datetime.datetime(2022, 9, 1, 12, 0),
+                NumericValue=101.5,
+            )
+        ],
+    )
+    changed_patients["event"] = 1
+
+    return changed_patients
+
+
+@pytest.mark.parametrize("name", ["study", "wide:12"])
+def test_incremental_results_match_full_run(fresh_backend, name):
+    definition = cohort_class_to_definition(get_cohort(name))
+    query_engine = sqlite.QueryEngine(definition, fresh_backend)
+    previous_results = [dict(row._mapping) for row in query_engine.iter_results()]
+
+    with fresh_backend.get_sqlalchemy_engine().begin() as connection:
+        add_changes(connection)
+
+    expected = sorted(map(tuple, query_engine.iter_results()))
+    results = sorted(
+        map(
+            as_tuple,
+            query_engine.iter_incremental_results(previous_results, SINCE, UNTIL),
+        )
+    )
+    assert results != sorted(map(as_tuple, previous_results))
+    assert results == expected
+
+
+def test_changed_patients_include_every_watermark(fresh_backend):
+    # Registrations have two watermark columns, and a row is changed if either
+    # of them is within the window
+    with fresh_backend.get_sqlalchemy_engine().begin() as connection:
+        changed_patients = add_changes(connection)
+    definition = cohort_class_to_definition(get_cohort("study"))
+    query_engine = sqlite.QueryEngine(definition, fresh_backend).get_incremental_engine(
+        SINCE, UNTIL
+    )
+    list(query_engine.iter_results())
+    # Some of the synthetic registrations already end within the window
+    for patient_id in changed_patients.values():
+        assert patient_id in query_engine.changed_patients
+    assert len(query_engine.changed_patients) < 20
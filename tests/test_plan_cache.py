@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from cohortextractor.plan_cache import CompiledPlan, PlanCache
+from cohortextractor.query_engines import sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks.cohorts import get_cohort
+
+
+def get_definition(name="study"):
+    return cohort_class_to_definition(get_cohort(name))
+
+
+def get_plan_files(plan_cache):
+    return sorted(
+        name for name in os.listdir(plan_cache.directory) if name.endswith(".json")
+    )
+
+
+def make_plan(size):
+    return CompiledPlan([], [], "SELECT 1" + " " * size, [])
+
+
+@pytest.fixture
+def no_compiling(monkeypatch):
+    """
+    Make compiling a plan fail, so that tests can check a plan came from the
+    cache
+    """
+
+    def get_plan(self):
+        raise AssertionError("Plan was compiled rather than read from the cache")
+
+    def disable():
+        monkeypatch.setattr(sqlite.QueryEngine, "get_plan", get_plan)
+
+    return disable
+
+
+@pytest.mark.parametrize("name", ["study", "wide:12", "deep:5"])
+def test_cached_plan_matches_query_engine(backend, tmp_path, name):
+    definition = get_definition(name)
+    plan_cache = PlanCache(tmp_path)
+    plan = plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    expected = sorted(sqlite.QueryEngine(definition, backend).iter_results())
+    assert len(expected) > 0
+    assert sorted(plan.iter_results(backend, batch_size=7)) == expected
+
+
+def test_second_call_is_read_from_cache(backend, tmp_path, no_compiling):
+    definition = get_definition()
+    plan_cache = PlanCache(tmp_path)
+    plan = plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    no_compiling()
+    cached_plan = plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    assert cached_plan.to_dict() == plan.to_dict()
+    assert len(get_plan_files(plan_cache)) == 1
+
+
+def test_execution_options_do_not_change_key(backend, tmp_path, no_compiling):
+    definition = get_definition()
+    plan_cache = PlanCache(tmp_path)
+    plan_cache.get_plan(definition, backend, sqlite.QueryEngine, max_workers=1)
+    no_compiling()
+    plan_cache.get_plan(
+        definition,
+        backend,
+        sqlite.QueryEngine,
+        max_workers=4,
+        batch_size=10,
+        tracer=print,
+        trace_plans=True,
+    )
+    assert len(get_plan_files(plan_cache)) == 1
+
+
+def test_compile_options_change_key(backend, tmp_path):
+    definition = get_definition()
+    plan_cache = PlanCache(tmp_path)
+    plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    plan_cache.get_plan(
+        definition, backend, sqlite.QueryEngine, results_join_batch_size=2
+    )
+    assert len(get_plan_files(plan_cache)) == 2
+
+
+def test_corrupt_plan_is_dropped(backend, tmp_path):
+    definition = get_definition()
+    plan_cache = PlanCache(tmp_path)
+    plan = plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    (file_name,) = get_plan_files(plan_cache)
+    path = tmp_path / file_name
+    path.write_text('{"codelist_statements": [')
+    assert plan_cache.load(file_name[: -len(".json")]) is None
+    assert not path.exists()
+    # The plan is compiled again and replaces the corrupt one
+    recompiled_plan = plan_cache.get_plan(definition, backend, sqlite.QueryEngine)
+    assert recompiled_plan.to_dict() == plan.to_dict()
+    assert get_plan_files(plan_cache) == [file_name]
+
+
+def test_least_recently_used_plans_are_evicted(tmp_path):
+    plan_cache = PlanCache(tmp_path, max_size=2500)
+    for index, key in enumerate(["a", "b", "c"]):
+        plan_cache.store(key, make_plan(1000))
+        # Modification times may not be fine grained enough to tell apart
+        # plans stored in quick succession
+        os.utime(plan_cache.get_path(key), (index, index))
+    assert get_plan_files(plan_cache) == ["b.json", "c.json"]
+    # Loading a plan marks it as recently used
+    assert plan_cache.load("b") is not None
+    os.utime(plan_cache.get_path("c"), (10, 10))
+    plan_cache.store("d", make_plan(1000))
+    assert get_plan_files(plan_cache) == ["b.json", "d.json"]
@@ -0,0 +1,92 @@
+"""
+The options which change how the query engine plans a cohort should never
+change its results, so each is checked against the default plan
+"""
+
+import pytest
+
+from cohortextractor.backends.tpp import Backend
+from cohortextractor.query_engines import sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks.cohorts import get_cohort
+
+COHORTS = ["study", "wide:12", "deep:5", "shared:10"]
+
+
+def get_sorted_results(name, backend, **options):
+    definition = cohort_class_to_definition(get_cohort(name))
+    query_engine = sqlite.QueryEngine(definition, backend, **options)
+    return sorted(map(tuple, query_engine.iter_results(batch_size=7)))
+
+
+def check_results_match_default(name, backend, **options):
+    expected = get_sorted_results(name, backend)
+    assert len(expected) > 0
+    assert get_sorted_results(name, backend, **options) == expected
+
+
+@pytest.mark.parametrize("population_first", [False, True])
+@pytest.mark.parametrize("name", COHORTS)
+def test_fuse_aggregates(backend, name, population_first):
+    check_results_match_default(
+        name, backend, fuse_aggregates=True, population_first=population_first
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"population_first": True},
+        {"fuse_aggregates": True},
+        # Only groups selecting from small enough tables are inlined
+        {"table_statistics": {"clinical_events": 10**9, "sgss_sars_cov_2": 10}},
+    ],
+)
+@pytest.mark.parametrize("name", COHORTS)
+def test_inline_groups(backend, name, options):
+    check_results_match_default(name, backend, inline_groups=True, **options)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"population_first": True},
+        {"inline_groups": True},
+        {"inline_groups": True, "population_first": True},
+        {"fuse_aggregates": True, "population_first": True},
+    ],
+)
+@pytest.mark.parametrize("batch_size", [2, 3, 100])
+@pytest.mark.parametrize("name", COHORTS)
+def test_results_join_batch_size(backend, name, batch_size, options):
+    check_results_match_default(
+        name, backend, results_join_batch_size=batch_size, **options
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 0, -2, 2.5, "3"])
+def test_results_join_batch_size_must_be_at_least_two(backend, batch_size):
+    with pytest.raises(ValueError, match="results_join_batch_size"):
+        get_sorted_results("study", backend, results_join_batch_size=batch_size)
+
+
+@pytest.mark.parametrize("options", [{}, {"results_join_batch_size": 10}])
+def test_results_are_staged_above_max_results_join_size(backend, options):
+    definition = cohort_class_to_definition(get_cohort("wide:12"))
+    query_engine = sqlite.QueryEngine(
+        definition, backend, max_results_join_size=3, **options
+    )
+    assert len(query_engine.result_stages) > 0
+    check_results_match_default("wide:12", backend, max_results_join_size=3, **options)
+
+
+def test_very_wide_cohort_compiles():
+    # Joining this many tables in a single query would exceed Python's
+    # recursion limit when SQLAlchemy compiles it
+    definition = cohort_class_to_definition(get_cohort("wide:800"))
+    query_engine = Backend.get_query_engine(definition)
+    assert len(query_engine.result_stages) > 0
+    assert query_engine.get_sql()
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from cohortextractor.materialisation_cache import MaterialisationCache
+from cohortextractor.query_engines import sqlite
+from cohortextractor.serialization import cohort_class_to_definition
+
+from benchmarks.cohorts import get_cohort
+
+
+def get_definition(name="study"):
+    return cohort_class_to_definition(get_cohort(name))
+
+
+class RecordingQueryEngine(sqlite.QueryEngine):
+    """
+    Records the index of every shard which is started, and fails those in
+    `failing_shards`
+    """
+
+    failing_shards = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started_shards = []
+
+    def get_shard_engine(self, index, count):
+        self.started_shards.append(index)
+        if index in self.failing_shards:
+            raise Exception(f"shard {index} failed")
+        return super().get_shard_engine(index, count)
+
+
+@pytest.mark.parametrize("parallel_shards", [1, 3])
+def test_merged_shards_match_unsharded_results(backend, parallel_shards):
+    query_engine = sqlite.QueryEngine(get_definition(), backend)
+    results = sorted(
+        query_engine.iter_sharded_results(
+            4, parallel_shards=parallel_shards, batch_size=7
+        )
+    )
+    expected = sorted(query_engine.iter_results())
+    assert len(expected) > 0
+    assert results == expected
+
+
+def test_shard_indexes_runs_only_those_shards(backend):
+    query_engine = RecordingQueryEngine(get_definition(), backend)
+    results = []
+    for index in range(4):
+        rows = list(query_engine.iter_sharded_results(4, shard_indexes=[index]))
+        assert query_engine.started_shards == [index]
+        assert all(row.patient_id % 4 == index for row in rows)
+        query_engine.started_shards.clear()
+        results.extend(rows)
+    assert sorted(results) == sorted(query_engine.iter_results())
+
+
+def test_failing_shard_is_named(backend):
+    query_engine = RecordingQueryEngine(get_definition(), backend)
+    query_engine.failing_shards = (2,)
+    with pytest.raises(RuntimeError, match=r"Shard 2 of 4 .* shard_indexes=\[2\]"):
+        list(query_engine.iter_sharded_results(4, parallel_shards=2))
+
+
+def test_closing_results_early_stops_shards(backend):
+    query_engine = RecordingQueryEngine(get_definition(), backend)
+    # Small batches mean the workers fill the queue and block long before
+    # they've finished
+    results = query_engine.iter_sharded_results(20, parallel_shards=2, batch_size=1)
+    next(results)
+    closer = threading.Thread(target=results.close)
+    closer.start()
+    closer.join(timeout=10)
+    assert not closer.is_alive()
+    assert len(query_engine.started_shards) < 20
+
+
+def test_parallel_shards_share_materialisation_cache(fresh_backend):
+    # The cache is too small to hold every table, so if any shard evicted
+    # tables as soon as it finished it would drop some which other shards had
+    # built but not yet read
+    cache = MaterialisationCache(max_rows=50)
+    definition = get_definition("wide:12")
+    query_engine = sqlite.QueryEngine(
+        definition, fresh_backend, materialisation_cache=cache
+    )
+    results = sorted(query_engine.iter_sharded_results(4, parallel_shards=4))
+    expected = sorted(sqlite.QueryEngine(definition, fresh_backend).iter_results())
+    assert results == expected